@@ -0,0 +1,380 @@
+"""
+离线基准测试：启动本地假Ollama服务，用合成字幕测量翻译流程的吞吐
+
+用法：
+    python bench.py --corpus small
+    python bench.py --corpus all --latency lognormal --mean 0.2 --workers 4 --batch 8
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import main
+
+# 合成字幕用的日语台词，包含大量重复的短句
+SAMPLE_LINES = [
+    "はい",
+    "えっ？",
+    "ちょっと待って！",
+    "お兄ちゃん、早く起きてよ",
+    "今日の放課後、一緒に帰らない？",
+    "べ、別にあんたのためじゃないんだからね！",
+    "この魔法陣…まさか古代の術式か",
+    "ドキドキ",
+    "先輩、お疲れ様です",
+    "もう遅いよ、行こう",
+    "何だと！？",
+    "ありがとう",
+]
+
+# 预设语料：(文件数, 每个文件的台词数)
+CORPORA = {
+    "small": (1, 200),
+    "10k": (1, 10000),
+    "many": (24, 300),
+}
+
+NUMBERED_PATTERN = re.compile(r"^\s*(\d+)\s*[.、]\s*(.*)$", re.M)
+# 模拟译文中把假名换成汉字，避免被译文校验当作残留假名
+KANA_TABLE = {code: "译" for code in range(0x3041, 0x30FB)}
+
+
+class FakeOllama:
+    """假的Ollama服务：按配置的延迟分布返回译文，并记录每个请求"""
+
+    def __init__(self, latency="fixed", mean=0.01, eval_tokens=0, seed=0, prompt_rate=0):
+        self.latency = latency
+        self.mean = mean
+        self.eval_tokens = eval_tokens
+        # 提示词处理速度（token/秒），0为不计入延迟
+        self.prompt_rate = prompt_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # 每个请求：(路径, 请求字节数, 提示词token数)
+        self.requests = []
+        self.server = None
+
+    def delay(self) -> float:
+        with self.lock:
+            if self.latency == "uniform":
+                return self.random.uniform(0, self.mean * 2)
+            if self.latency == "lognormal":
+                # 中位数约为mean，带长尾
+                return self.random.lognormvariate(0, 0.75) * self.mean
+            return self.mean
+
+    def reply(self, last: str) -> str:
+        """模拟翻译：批量请求按编号逐行返回，否则返回单行"""
+        numbered = NUMBERED_PATTERN.findall(last)
+        if len(numbered) > 1:
+            return "\n".join(
+                f"{i}. 译：{text.translate(KANA_TABLE)}" for i, text in numbered
+            )
+        return "译：" + last.strip().translate(KANA_TABLE)
+
+    def respond(self, path: str, size: int, prompt_tokens: int, last: str) -> tuple:
+        """模拟一次推理：按提示词token数和延迟分布等待，返回(译文, 统计字段)"""
+        with self.lock:
+            self.requests.append((path, size, prompt_tokens))
+        prompt_seconds = prompt_tokens / self.prompt_rate if self.prompt_rate else 0
+        delay = self.delay()
+        time.sleep(prompt_seconds + delay)
+        content = self.reply(last)
+        eval_count = self.eval_tokens or main.estimateTokens(content)
+        # 未单独设置提示词速度时按三七开把延迟分给提示词处理和生成，单位纳秒
+        if not self.prompt_rate:
+            prompt_seconds, delay = delay * 0.3, delay * 0.7
+        return content, {
+            "model": None,
+            "done": True,
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(prompt_seconds * 1e9),
+            "eval_count": eval_count,
+            "eval_duration": int(delay * 1e9),
+            "load_duration": 0,
+            "total_duration": int((prompt_seconds + delay) * 1e9),
+        }
+
+    def handleChat(self, payload: dict, size: int) -> dict:
+        messages = payload.get("messages", [])
+        prompt_tokens = sum(main.estimateTokens(m["content"]) + 4 for m in messages)
+        content, data = self.respond(
+            "/api/chat", size, prompt_tokens, messages[-1]["content"] if messages else ""
+        )
+        data["model"] = payload.get("model")
+        data["message"] = {"role": "assistant", "content": content}
+        return data
+
+    def handleGenerate(self, payload: dict, size: int) -> dict:
+        """模拟KV缓存：只有context之后的新内容需要处理，返回延长后的context"""
+        prompt = payload.get("prompt", "")
+        new_text = prompt + ("" if payload.get("context") else payload.get("system", ""))
+        prompt_tokens = main.estimateTokens(new_text) + 4
+        content, data = self.respond("/api/generate", size, prompt_tokens, prompt)
+        context = list(payload.get("context") or [])
+        context.extend([0] * (prompt_tokens + data["eval_count"]))
+        data["model"] = payload.get("model")
+        data["response"] = content
+        data["context"] = context
+        return data
+
+    def handleEmbed(self, payload: dict, size: int) -> dict:
+        """按字符二元组哈希成固定维度的向量，相似的台词向量也相近"""
+        texts = payload.get("input") or []
+        texts = [texts] if isinstance(texts, str) else texts
+        with self.lock:
+            self.requests.append(("/api/embed", size, 0))
+        embeddings = []
+        for text in texts:
+            vector = [0.0] * 64
+            for a, b in zip(text, text[1:] + " "):
+                vector[hash(a + b) % 64] += 1.0
+            norm = sum(v * v for v in vector) ** 0.5 or 1.0
+            embeddings.append([v / norm for v in vector])
+        return {"model": payload.get("model"), "embeddings": embeddings}
+
+    def makeHandler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # 头和正文分两次写出，关闭Nagle避免每个请求多出约40毫秒
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, body: bytes, status: int = 200):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self.send(b'{"version":"bench"}')
+
+            def do_POST(self):
+                size = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(size))
+                if self.path == "/api/embed":
+                    data = fake.handleEmbed(payload, size)
+                    self.send(json.dumps(data).encode("utf-8"))
+                    return
+                if self.path == "/api/generate":
+                    data = fake.handleGenerate(payload, size)
+                elif self.path == "/api/chat":
+                    data = fake.handleChat(payload, size)
+                else:
+                    self.send(b'{"error":"not found"}', 404)
+                    return
+                if payload.get("stream"):
+                    # 按字拆成NDJSON流，context只在最后一块
+                    if "response" in data:
+                        chunks = [{"response": ch, "done": False} for ch in data["response"]]
+                        data["response"] = ""
+                    else:
+                        chunks = [
+                            {"message": {"role": "assistant", "content": ch}, "done": False}
+                            for ch in data["message"]["content"]
+                        ]
+                        data["message"]["content"] = ""
+                    chunks.append(data)
+                    body = "".join(json.dumps(c) + "\n" for c in chunks)
+                    self.send(body.encode("utf-8"))
+                else:
+                    self.send(json.dumps(data).encode("utf-8"))
+
+        return Handler
+
+    def start(self) -> str:
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.makeHandler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def writeCorpus(folder: str, files: int, lines: int, seed: int = 0):
+    """生成合成SRT字幕"""
+    rng = random.Random(seed)
+    for n in range(files):
+        path = os.path.join(folder, f"episode_{n + 1:02d}.srt")
+        with open(path, "w", encoding="utf-8") as f:
+            for i in range(lines):
+                start = i * 3
+                f.write(f"{i + 1}\n")
+                f.write(
+                    f"{start // 3600:02d}:{start // 60 % 60:02d}:{start % 60:02d},000 --> "
+                    f"{start // 3600:02d}:{start // 60 % 60:02d}:{start % 60:02d},900\n"
+                )
+                f.write(f"{rng.choice(SAMPLE_LINES)}\n\n")
+
+
+def runCorpus(name: str, args) -> dict:
+    files, lines = CORPORA[name]
+    fake = FakeOllama(args.latency, args.mean, args.eval_tokens, args.seed, args.prompt_rate)
+    host = fake.start()
+    work_dir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    # 把翻译器指向临时目录和假服务
+    main.API_URL.chat = f"{host}/api/chat"
+    main.API_URL.generate = f"{host}/api/generate"
+    main.API_URL.embeddings = f"{host}/api/embed"
+    main.shared_pool = None
+    main.origin_folder = os.path.join(work_dir, "1_origin")
+    main.translate_folder = os.path.join(work_dir, "2_translate")
+    main.log_folder = os.path.join(work_dir, "5_logs")
+    main.cache_folder = os.path.join(work_dir, "6_cache")
+    main.initFolder()
+    main.batch_size = args.batch
+    main.use_stream = args.stream
+    main.use_memory = args.memory
+    main.use_journal = False
+    main.use_retrieval = args.retrieval
+    main.engine = args.engine
+    main.retrieval_indexes = {}
+    main.metrics = main.Metrics()
+    writeCorpus(main.origin_folder, files, lines, args.seed)
+    if args.memory:
+        main.openMemory()
+
+    stdout = sys.stdout
+    start = time.perf_counter()
+    try:
+        # 翻译过程的逐行输出不计入测试
+        with open(os.devnull, "w", encoding="utf-8") as devnull:
+            sys.stdout = devnull
+            failed = main.runScheduler(sorted(main.collectFiles()), args.workers)
+    finally:
+        sys.stdout = stdout
+        elapsed = time.perf_counter() - start
+        fake.stop()
+        if main.translation_memory:
+            main.translation_memory.close()
+            main.translation_memory = None
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    # 只统计翻译请求，向量化请求单独计数
+    chats = [r for r in fake.requests if r[0] != "/api/embed"]
+    sizes = [r[1] for r in chats]
+    prompts = [r[2] for r in chats]
+    tenth = max(1, len(prompts) // 10)
+    return {
+        "corpus": name,
+        "engine": args.engine,
+        "files": files,
+        "lines": files * lines,
+        "failed": len(failed),
+        "seconds": round(elapsed, 3),
+        "lines_per_sec": round(files * lines / elapsed, 2) if elapsed else 0,
+        "requests": len(chats),
+        "embed_requests": len(fake.requests) - len(chats),
+        "bytes_per_request": round(statistics.mean(sizes)) if sizes else 0,
+        "bytes_p95": main.percentile(sizes, 0.95),
+        "prompt_tokens_first": round(statistics.mean(prompts[:tenth])) if prompts else 0,
+        "prompt_tokens_last": round(statistics.mean(prompts[-tenth:])) if prompts else 0,
+        "prompt_tokens_max": max(prompts, default=0),
+        "prompt_tokens_total": sum(prompts),
+        "metrics": main.metrics.run.summary(),
+    }
+
+
+def report(result: dict):
+    growth = (
+        result["prompt_tokens_last"] / result["prompt_tokens_first"]
+        if result["prompt_tokens_first"]
+        else 0
+    )
+    print(
+        f"[{result['corpus']}/{result['engine']}] {result['files']}个文件 {result['lines']}行 "
+        f"耗时{result['seconds']}秒 失败{result['failed']}个\n"
+        f"  吞吐：{result['lines_per_sec']}行/秒，请求数：{result['requests']}"
+        f"（向量化{result['embed_requests']}）\n"
+        f"  每请求字节：平均{result['bytes_per_request']}，p95 {result['bytes_p95']}\n"
+        f"  提示词token：开头{result['prompt_tokens_first']} -> "
+        f"结尾{result['prompt_tokens_last']}（x{growth:.2f}），最大{result['prompt_tokens_max']}，"
+        f"合计{result['prompt_tokens_total']}\n"
+        f"  延迟：p50 {result['metrics']['latency_p50']}秒，p95 {result['metrics']['latency_p95']}秒"
+    )
+
+
+def compare(chat: dict, generate: dict):
+    """两种接口的提示词处理量和每行延迟对比"""
+    lines = chat["lines"] or 1
+    print(
+        f"[{chat['corpus']}] generate/chat："
+        f"提示词token合计 {generate['prompt_tokens_total']}/{chat['prompt_tokens_total']}"
+        f"（x{generate['prompt_tokens_total'] / (chat['prompt_tokens_total'] or 1):.2f}），"
+        f"每行耗时 {generate['seconds'] / lines * 1000:.1f}/{chat['seconds'] / lines * 1000:.1f}毫秒，"
+        f"延迟p50 {generate['metrics']['latency_p50']}/{chat['metrics']['latency_p50']}秒"
+    )
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="400翻译器离线基准测试")
+    parser.add_argument(
+        "--corpus", choices=[*CORPORA, "all"], default="small", help="合成语料规模"
+    )
+    parser.add_argument(
+        "--latency",
+        choices=["fixed", "uniform", "lognormal"],
+        default="fixed",
+        help="假服务的延迟分布",
+    )
+    parser.add_argument("--mean", type=float, default=0.01, help="平均延迟（秒）")
+    parser.add_argument(
+        "--eval-tokens", type=int, default=0, help="固定的生成token数，0为按译文估算"
+    )
+    parser.add_argument("--workers", type=int, default=1, help="并发文件数")
+    parser.add_argument("--batch", type=int, default=1, help="每次请求打包的行数")
+    parser.add_argument("--stream", action="store_true", help="使用流式接收")
+    parser.add_argument("--memory", action="store_true", help="启用翻译记忆")
+    parser.add_argument("--retrieval", action="store_true", help="启用检索上下文")
+    parser.add_argument(
+        "--engine",
+        choices=["chat", "generate", "both"],
+        default="chat",
+        help="请求接口，both为两者对比",
+    )
+    parser.add_argument(
+        "--prompt-rate",
+        type=float,
+        default=0,
+        help="假服务的提示词处理速度（token/秒），0为不计入延迟",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--json", help="把结果追加写入JSONL文件")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parseArgs()
+    names = list(CORPORA) if args.corpus == "all" else [args.corpus]
+    engines = ["chat", "generate"] if args.engine == "both" else [args.engine]
+    for name in names:
+        results = []
+        for engine in engines:
+            args.engine = engine
+            result = runCorpus(name, args)
+            report(result)
+            results.append(result)
+            if args.json:
+                with open(args.json, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        args.engine = "both" if len(engines) > 1 else engines[0]
+        if len(results) == 2:
+            compare(*results)
@@ -1,12 +1,37 @@
 import requests
+from requests.adapters import HTTPAdapter
+import argparse
 import json
+import random
+import unicodedata
 import threading
 import time
 import re
 import os
 import sys
 import datetime
+import hashlib
+import sqlite3
+import queue
+import signal
 from pathlib import Path
+from urllib.parse import urlsplit
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+# 守护模式有watchdog时用文件系统事件监视文件夹，未安装时轮询
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+
+# 检索上下文需要numpy，未安装时该功能关闭
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # 系统提示词
 systemPrompt_str = """
@@ -39,6 +64,14 @@ systemPrompt_str = """
 请根据以上规则，将发送给你的文字翻译为最地道的ACG中文。
 """
 
+# 批量翻译提示词，{count}为本次打包的行数
+batchPrompt_str = """请逐行翻译下面带编号的{count}行文字，每行单独翻译。
+保持编号和行数不变，每行严格按“编号. 译文”的格式输出，不要合并或拆分行：
+"""
+
+# 校验未通过后重试时加在原文前的提示
+retryPrompt_str = "（只输出这句的中文译文，不要解释，不要输出思考过程，不要保留日文假名）\n"
+
 # 标记是否在运行
 running_tag = True
 
@@ -46,13 +79,189 @@ running_tag = True
 TIMESTAMP_PATTERN = re.compile(
     r"^\s*\d{2}:\d{2}:\d{2},\d{3}\s*-->\s*\d{2}:\d{2}:\d{2},\d{3}\s*$"
 )
+# 预编译SRT时间轴正则（取出起止时间）
+SRT_TIMING_PATTERN = re.compile(
+    r"^\s*(\d{1,2}:\d{2}:\d{2}[,.]\d{3})\s*-->\s*(\d{1,2}:\d{2}:\d{2}[,.]\d{3})"
+)
+# 预编译VTT时间轴正则，小时可省略，后面可跟位置设置
+VTT_TIMING_PATTERN = re.compile(
+    r"^\s*((?:\d+:)?\d{2}:\d{2}\.\d{3})\s*-->\s*((?:\d+:)?\d{2}:\d{2}\.\d{3})"
+)
+# 预编译ASS特效标签正则
+ASS_TAG_PATTERN = re.compile(r"\{[^}]*\}")
+# 预编译中日韩字符正则，用于估算token数
+CJK_PATTERN = re.compile(r"[\u3000-\u30ff\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]")
+# 预编译纯假名正则（含长音符）
+KANA_PATTERN = re.compile(r"^[\u3040-\u30ff]+$")
+# 句尾标点，查静态表时去掉，译文中保留
+TRAILING_PUNCT = "。、！？!?…・～~.,　 "
+# 预编译ANSI转义序列正则，写入日志文件时去掉颜色
+ANSI_PATTERN = re.compile(r"\x1b\[[0-9;]*m")
+# 预编译字幕时间正则（SRT/VTT/ASS通用），用于按时间间隔切分场景
+CUE_TIME_PATTERN = re.compile(r"^\s*(?:(\d+):)?(\d{1,2}):(\d{1,2})[,.](\d+)")
+# 预编译译文校验用的正则：思考过程、解释性文字、残留假名（不含中文也用的・ー）
+THINK_PATTERN = re.compile(r"<think>.*?(?:</think>|$)", re.S)
+EXPLANATION_PATTERN = re.compile(
+    r"^\s*(?:翻译如下|译文如下|以下是|翻译[:：]|译文[:：]|注[:：]|这里用了)", re.M
+)
+KANA_RESIDUE_PATTERN = re.compile(r"[\u3041-\u3096\u30a1-\u30fa]")
+# 预编译批量回复的编号行正则
+BATCH_LINE_PATTERN = re.compile(r"^\s*(\d+)\s*[.、．:：)）]\s*(.*)$")
 
 origin_folder = ".\\1_origin"
 translate_folder = ".\\2_translate"
 log_folder = ".\\5_logs"
+cache_folder = ".\\6_cache"
 log_file = f"{datetime.datetime.now().strftime("%Y-%m-%d")}.log"
 prefix = ""
 suffix = "_ch"
+# 同时翻译的文件数，1为逐个处理（大于1时需Ollama设置OLLAMA_NUM_PARALLEL）
+max_workers = 1
+# 每次请求打包的字幕行数，1为逐行翻译
+batch_size = 1
+# 译文校验：残留假名、解释性文字、思考过程、长度比例异常的字幕放入重试队列，只重译这些字幕
+use_validation = True
+validation_kana_max = 1  # 译文中允许的假名个数（如“の”）
+validation_min_length = 6  # 原文达到该长度才检查长度比例
+validation_min_ratio = 0.2  # 译文/原文长度比例的下限
+validation_max_ratio = 4.0  # 译文/原文长度比例的上限
+validation_retries = 2  # 重试次数：第一次加严提示词，之后换备用模型
+abort_after_failures = 5  # 连续请求失败达到该次数时放弃文件（服务可能已停止）
+# 单个文件内同时翻译的场景数，1为关闭；各场景有独立的上下文，最后按顺序拼回
+scene_workers = 1
+scene_gap_seconds = 5.0  # 相邻字幕间隔超过该秒数时可切分场景
+scene_min_cues = 20  # 场景至少包含的字幕数，避免切得太碎
+scene_max_cues = 150  # 场景最多包含的字幕数，没有时间轴时按该条数切分
+scene_overlap = 3  # 每个场景开头带上前一场景末尾的几条作为上下文
+
+# 请求接口："chat"每次发送完整的对话记录；"generate"保留Ollama返回的context，每句只发送新内容
+engine = "chat"
+context_rebase_ratio = 0.8  # context超过num_ctx的该比例时，下一句用最近的对话重新建立
+rebase_turns = 8  # 重新建立时带上的最近对话轮数
+
+# 上下文窗口（token），历史记录按预算裁剪
+num_ctx = 8192
+context_budget_ratio = 0.6  # 系统提示词+历史记录最多占用的比例，其余留给输出
+history_summary = False  # True时被裁掉的旧译文压缩成摘要保留在上下文中
+summary_max_tokens = 256  # 摘要的token上限
+
+# 网络传输：连接池、超时、重试和熔断
+pool_size = 16  # 连接池大小，不小于并发数
+connect_timeout = 5  # 连接超时（秒）
+read_timeout = 300  # 读取超时（秒），模型加载慢时适当调大
+max_retries = 4  # 连接错误和5xx的重试次数
+retry_backoff = 1.0  # 重试等待基数（秒），按指数增长并加随机抖动
+retry_backoff_max = 30  # 单次重试最长等待（秒）
+breaker_threshold = 5  # 连续失败多少次后熔断
+breaker_cooldown = 30  # 熔断后暂停多久再试探（秒）
+
+# 多个Ollama实例：[(地址, 最大并发请求数)]，为空时只用API_URL中的地址
+ollama_endpoints = []
+health_check_interval = 15  # 后端健康检查间隔（秒）
+
+# 术语表：每个系列文件夹下的该文件，每行“原文=译文”，子文件夹的同名条目优先
+glossary_name = "glossary.txt"
+
+# 分流：感叹词/拟声词查静态表，短的纯假名句交给小模型，其余交给大模型
+use_routing = False
+light_max_length = 6  # 不超过该字数的纯假名句走小模型
+# 常见感叹词和拟声词的固定译法（键为去掉句尾标点的原文）
+STATIC_TRANSLATIONS = {
+    "はい": "嗯",
+    "うん": "嗯",
+    "ええ": "嗯",
+    "いいえ": "不是",
+    "ううん": "不是啦",
+    "えっ": "诶",
+    "え": "诶",
+    "ええっ": "诶诶",
+    "あっ": "啊",
+    "あ": "啊",
+    "あれ": "咦",
+    "おい": "喂",
+    "ねえ": "呐",
+    "よし": "好",
+    "はあ": "哈啊",
+    "ふん": "哼",
+    "ありがとう": "谢谢",
+    "ごめん": "抱歉",
+    "ドキドキ": "（扑通扑通）",
+    "シーン": "（死寂）",
+    "じーっ": "（盯——）",
+    "ニコッ": "（微笑）",
+    "ゴゴゴ": "（轰隆隆）",
+}
+
+# 模型常驻：启动时预加载，运行期间一直留在显存，结束时卸载
+preload_models = True
+keep_alive = -1  # 请求携带的keep_alive，-1为一直保留
+unload_at_exit = True
+
+# 运行指标：记录Ollama返回的耗时字段，按文件和整次运行汇总
+metrics_file = f"metrics_{datetime.datetime.now().strftime("%Y-%m-%d")}.jsonl"
+metrics_port = 0  # Prometheus文本格式的指标端口，0为不开启
+metrics_host = "127.0.0.1"
+report_interval = 30  # 运行中输出一次汇总的间隔（秒）
+load_stall_seconds = 1.0  # 模型加载超过该时间记为一次加载停顿
+
+# 守护模式：常驻监视原文件夹，新增或修改的文件进入持久化任务队列，模型保持常驻
+queue_file = "jobs.sqlite3"
+status_file = "status.json"  # 守护模式状态文件，写在日志文件夹
+status_interval = 5  # 写状态文件的间隔（秒）
+watch_interval = 10  # 轮询原文件夹的间隔（秒）
+watch_settle_seconds = 3  # 文件大小和修改时间保持不变该秒数后才入队
+warm_interval = 300  # 空闲时每隔该秒数确认一次模型仍在内存中
+job_max_attempts = 3  # 失败的任务最多尝试次数
+job_retry_delay = 60  # 失败重试的等待时间（秒），按次数递增
+
+# 流式接收：统计首字延迟，并提前中止跑偏的生成
+use_stream = False
+stream_length_ratio = 4.0  # 译文最长为原文字数的倍数
+stream_length_slack = 40  # 在倍数之外额外允许的字数
+stream_max_seconds = 60  # 单次生成的最长时间（秒）
+
+# 翻译记忆：相同模型+提示词+原文+前文的翻译直接复用
+use_memory = True
+memory_file = "memory.sqlite3"
+memory_max_entries = 200000  # 超出后按最近使用淘汰
+memory_context_size = 4  # 参与缓存键的前文消息条数
+memory_ignore_context = False  # True时只按原文匹配，适合OP/ED和常用短句
+# 全局翻译记忆，运行时初始化
+translation_memory = None
+
+# 检索上下文：已译的原文/译文对按系列向量化保存，每次请求只带最相似的几条和最近几轮对话
+use_retrieval = False
+retrieval_top_k = 4  # 每次请求附带的参考译文条数
+retrieval_recent = 2  # 保留的最近对话轮数
+retrieval_min_score = 0.6  # 余弦相似度低于该值的不作参考
+embed_batch_size = 32  # 每次向量化请求的原文条数
+
+# 断点续翻：记录每个文件已完成的行，崩溃后从断点继续，已完成的文件直接跳过
+use_journal = True
+# 断点记录格式版本，序号含义变化时递增使旧记录作废
+JOURNAL_VERSION = 2
+
+# 预扫描计划：出现多次的短句先统一翻译一次，再分发到所有文件
+use_plan = True
+duplicate_min_count = 3  # 出现次数达到该值才统一翻译
+duplicate_max_length = 20  # 只统一翻译不超过该字数的短句，长句仍依赖上下文
+default_lines_per_second = 0.5  # 没有实测吞吐时用于估算耗时
+throughput_file = "throughput.json"  # 实测吞吐记录，保存在缓存文件夹
+# 重复短句的统一译文：规范化原文 -> 译文
+shared_translations = {}
+# 本次运行实际请求模型翻译的字幕数
+translated_cues = 0
+stats_lock = threading.Lock()
+
+# 终端输出详细程度：0不输出，1只输出文件进度和汇总，2输出逐行原文译文
+console_level = 2
+LEVEL_INFO = 1
+LEVEL_DETAIL = 2
+log_max_bytes = 50 * 1024 * 1024  # 单个日志文件上限，超出后轮转
+log_batch_size = 256  # 后台线程每次最多合并写入的条数
+
+# 线程内的输出缓冲，并发时每个文件的输出先攒着，按文件顺序统一打印
+thread_output = threading.local()
 
 
 class Models:
@@ -64,9 +273,26 @@ class Models:
 
 
 class API_URL:
-    generate = "http://localhost:11434/api/generate"
-    chat = "http://localhost:11434/api/chat"
-    embeddings = "http://localhost:11434/api/embed"
+    host = "http://localhost:11434"
+    generate = f"{host}/api/generate"
+    chat = f"{host}/api/chat"
+    embeddings = f"{host}/api/embed"
+
+
+# 小模型，分流时处理简单的短句
+light_model = Models.qwen2
+# 备用模型，校验重试时使用
+fallback_model = Models.qwen3
+# 向量模型，检索上下文时使用
+embed_model = "nomic-embed-text"
+
+
+class Route:
+    table = "静态表"
+    shared = "统一译文"
+    memory = "翻译记忆"
+    light = "小模型"
+    heavy = "大模型"
 
 
 class Role:
@@ -88,115 +314,2176 @@ class Message:
         return self.content
 
 
-class OllamaClient:
-    def chat(self, payload: dict) -> str:
+def modelOptions() -> dict:
+    """翻译请求和预加载共用的模型参数；num_ctx等加载参数不一致时Ollama会重新加载模型"""
+    return {
+        "num_ctx": num_ctx,  # 上下文窗口
+        "temperature": 0.7,  # 生成温度/发散度
+        "num_gpu": -1,  # GPU层数，-1强制用满GPU
+        "num_thread": 16,  # CPU线程数，填内核/逻辑线程数量
+        "num_batch": 128,  # 批量推理大小，根据显存推算
+        "repeat_penalty": 1.05,  # 重复惩罚，1为默认值
+        "top_k": 20,  # 候选词数量，20为默认值
+        "top_p": 0.95,  # 核采样阈值，0.95为默认值
+    }
+
+
+def estimateTokens(text: str) -> int:
+    """粗略估算token数：中日文约1字1token，其余约4字符1token"""
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def estimateMessageTokens(mess: Message) -> int:
+    # 每条消息额外约4个token的角色与分隔符开销
+    return estimateTokens(mess.get_content()) + 4
+
+
+class RetryableError(Exception):
+    """服务端5xx等可重试的错误"""
+
+
+class CircuitBreaker:
+    """连续失败达到阈值后熔断，冷却期内所有请求暂停，冷却后放行试探"""
+
+    def __init__(self, threshold: int = None, cooldown: float = None):
+        self.threshold = breaker_threshold if threshold is None else threshold
+        self.cooldown = breaker_cooldown if cooldown is None else cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.open_until = 0.0
+
+    def isOpen(self) -> bool:
+        return time.monotonic() < self.open_until
+
+    def wait(self):
+        """熔断期间阻塞调用线程，相当于暂停调度"""
+        while True:
+            remaining = self.open_until - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 1.0))
+
+    def success(self):
+        with self.lock:
+            if self.failures >= self.threshold:
+                print(f"{Highlight.GREEN}服务已恢复{Highlight.RESET}")
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold and not self.isOpen():
+                self.open_until = time.monotonic() + self.cooldown
+                print(
+                    f"{Highlight.RED}服务不可用，暂停{self.cooldown}秒：{Highlight.RESET}"
+                    f"连续失败{self.failures}次"
+                )
+
+
+class Transport:
+    """共享的HTTP传输层：长连接池、连接/读取超时、指数退避重试、熔断"""
+
+    def __init__(self, breaker: CircuitBreaker = None):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.breaker = breaker or CircuitBreaker()
+
+    def backoff(self, attempt: int) -> float:
+        """第attempt次重试的等待时间，带随机抖动避免多个线程同时重试"""
+        delay = min(retry_backoff_max, retry_backoff * 2**attempt)
+        return random.uniform(delay / 2, delay)
+
+    def post(
+        self,
+        url: str,
+        payload: dict,
+        stream: bool = False,
+        breaker: CircuitBreaker = None,
+    ):
+        breaker = breaker or self.breaker
+        for attempt in range(max_retries + 1):
+            breaker.wait()
+            try:
+                response = self.session.post(
+                    url,
+                    json=payload,
+                    stream=stream,
+                    timeout=(connect_timeout, read_timeout),
+                )
+                if response.status_code >= 500:
+                    response.close()
+                    raise RetryableError(f"服务端错误{response.status_code}")
+                response.raise_for_status()  # 4xx属于请求本身的问题，不重试
+                breaker.success()
+                return response
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                RetryableError,
+            ) as e:
+                breaker.failure()
+                if attempt >= max_retries:
+                    raise ConnectionError(f"重试{max_retries}次后仍失败：{e}") from e
+                delay = self.backoff(attempt)
+                print(
+                    f"{Highlight.YELLOW}请求失败，{delay:.1f}秒后第{attempt + 1}次重试：{Highlight.RESET}{e}"
+                )
+                time.sleep(delay)
+
+    def close(self):
+        self.session.close()
+
+
+# 全局共享的传输层，首次使用时创建
+shared_transport = None
+transport_lock = threading.Lock()
+
+
+def getTransport() -> Transport:
+    global shared_transport
+    with transport_lock:
+        if shared_transport is None:
+            shared_transport = Transport()
+        return shared_transport
+
+
+class Cue:
+    """一条字幕：序号、起止时间、文本行，header为文本前原样写回的内容"""
+
+    __slots__ = ("index", "start", "end", "lines", "header")
+
+    def __init__(self, index, start, end, lines, header=""):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.lines = lines
+        self.header = header
+
+    def text(self) -> str:
+        return "\n".join(self.lines)
+
+
+class TextParser:
+    """纯文本：沿用逐行规则，空行、序号行、时间戳行原样保留，其余每行一条"""
+
+    def isPlain(self, line: str) -> bool:
+        stripped_line = line.strip()
+        if not stripped_line:
+            return True  # 空行
+        if stripped_line.isdigit():
+            return True  # 序列行
+        if TIMESTAMP_PATTERN.match(line):
+            return True  # 时间戳行
+        return False  # 正常文本
+
+    def parse(self, file):
+        """逐行产出：原样保留的行为str，需要翻译的为Cue"""
+        for count, line in enumerate(file, 1):
+            if self.isPlain(line):
+                yield line
+            else:
+                yield Cue(count, None, None, [line.rstrip("\r\n")])
+
+    def splitTranslation(self, cue: Cue, translation: str) -> list:
+        """把译文拆回与原文对应的行，不允许出现空行破坏结构"""
+        lines = [line.strip() for line in translation.splitlines() if line.strip()]
+        count = len(cue.lines)
+        if len(lines) == 1 and count > 1:
+            # 批量翻译时多行字幕以 / 连接
+            parts = [part.strip() for part in lines[0].split("/") if part.strip()]
+            if len(parts) == count:
+                lines = parts
+        return lines or [line.strip() for line in cue.lines]
+
+    def write(self, file, cue: Cue, translation: str):
+        file.write(cue.header)
+        file.write("\n".join(self.splitTranslation(cue, translation)))
+        file.write("\n")
+
+
+class SrtParser(TextParser):
+    """SRT：序号行 + 时间轴行 + 若干文本行 + 空行"""
+
+    TIMING = SRT_TIMING_PATTERN
+
+    def isIdentifier(self, line: str) -> bool:
+        return line.strip().isdigit()
+
+    def parse(self, file):
+        held = None  # 可能是序号的上一行
+        cue = None
+        for line in file:
+            if cue is not None:
+                if line.strip():
+                    cue.lines.append(line.rstrip("\r\n"))
+                    continue
+                # 空行结束当前字幕
+                yield cue
+                cue = None
+                yield line
+                continue
+            match = self.TIMING.match(line)
+            if match:
+                header = (held or "") + line
+                index = held.strip() if held else None
+                held = None
+                cue = Cue(index, match.group(1), match.group(2), [], header)
+                continue
+            if held is not None:
+                yield held
+                held = None
+            if self.isIdentifier(line):
+                held = line
+            else:
+                yield line
+        if held is not None:
+            yield held
+        if cue is not None:
+            yield cue
+
+
+class VttParser(SrtParser):
+    """WebVTT：可选的标识行 + 时间轴行 + 文本行，NOTE/STYLE块原样保留"""
+
+    TIMING = VTT_TIMING_PATTERN
+
+    def isIdentifier(self, line: str) -> bool:
+        stripped_line = line.strip()
+        return bool(stripped_line) and stripped_line != "WEBVTT" and "-->" not in line
+
+
+class AssParser(TextParser):
+    """ASS/SSA：只翻译Dialogue行的文本字段，\\N为行内换行"""
+
+    def parse(self, file):
+        for line in file:
+            if not line.startswith("Dialogue:"):
+                yield line
+                continue
+            fields = line.rstrip("\r\n").split(",", 9)
+            if len(fields) < 10:
+                yield line
+                continue
+            text = fields[9]
+            # 保留行首的特效标签，行内标签不送去翻译
+            leading = re.match(r"^(\{[^}]*\})*", text).group(0)
+            lines = [ASS_TAG_PATTERN.sub("", part) for part in text.split("\\N")]
+            if not "".join(lines).strip():
+                yield line
+                continue
+            header = ",".join(fields[:9]) + "," + leading
+            yield Cue(None, fields[1], fields[2], lines, header)
+
+    def write(self, file, cue: Cue, translation: str):
+        file.write(cue.header)
+        file.write("\\N".join(self.splitTranslation(cue, translation)))
+        file.write("\n")
+
+
+# 按扩展名选择解析器，其余格式按纯文本逐行处理
+PARSERS = {
+    ".srt": SrtParser,
+    ".vtt": VttParser,
+    ".ass": AssParser,
+    ".ssa": AssParser,
+}
+
+
+def getParser(path: str) -> TextParser:
+    ext = os.path.splitext(path)[1].lower()
+    return PARSERS.get(ext, TextParser)()
+
+
+class Endpoint:
+    """一个Ollama实例：并发上限、当前请求数、绑定的对话数和健康状态"""
+
+    def __init__(self, host: str, limit: int):
+        self.host = host.rstrip("/")
+        self.limit = max(1, limit)
+        self.slots = threading.Semaphore(self.limit)
+        self.outstanding = 0
+        self.pinned = 0
+        self.healthy = True
+        self.breaker = CircuitBreaker()
+
+    def url(self, api_url: str) -> str:
+        """把API_URL中的接口路径换到本实例上"""
+        return self.host + urlsplit(api_url).path
+
+    def load(self) -> float:
+        return (self.outstanding + self.pinned) / self.limit
+
+
+class BackendPool:
+    """多后端负载均衡：按最少未完成请求分配，失效的后端移出，恢复后重新加入"""
+
+    def __init__(self, endpoints: list, transport: Transport):
+        self.endpoints = [Endpoint(host, limit) for host, limit in endpoints]
+        self.transport = transport
+        self.lock = threading.Lock()
+        self.checker = None
+        self.stopped = threading.Event()
+
+    def healthy(self) -> list:
+        return [e for e in self.endpoints if e.healthy]
+
+    def pin(self, previous: Endpoint = None, exclude=()) -> Endpoint:
+        """为一个对话选定后端，之后的请求都发往同一个实例以复用提示词缓存"""
+        with self.lock:
+            candidates = [e for e in self.healthy() if e not in exclude]
+            if not candidates:
+                # 没有替换的后端时原绑定保持不变，由对话结束时的unpin释放
+                return None
+            if previous:
+                previous.pinned -= 1
+            endpoint = min(candidates, key=Endpoint.load)
+            endpoint.pinned += 1
+            return endpoint
+
+    def unpin(self, endpoint: Endpoint):
+        with self.lock:
+            endpoint.pinned -= 1
+
+    def acquire(self, endpoint: Endpoint):
+        endpoint.slots.acquire()
+        with self.lock:
+            endpoint.outstanding += 1
+
+    def release(self, endpoint: Endpoint):
+        with self.lock:
+            endpoint.outstanding -= 1
+        endpoint.slots.release()
+
+    def markDown(self, endpoint: Endpoint):
+        """移出失效的后端，最后一个可用后端保留，由熔断器负责暂停"""
+        with self.lock:
+            if not endpoint.healthy or len(self.healthy()) <= 1:
+                return
+            endpoint.healthy = False
+        print(f"{Highlight.RED}后端已移出：{Highlight.RESET}{endpoint.host}")
+
+    def check(self, endpoint: Endpoint) -> bool:
         try:
-            response = requests.post(API_URL.chat, json=payload)
-            response.raise_for_status()
+            response = self.transport.session.get(
+                endpoint.host + "/api/version",
+                timeout=(connect_timeout, connect_timeout),
+            )
+            return response.ok
+        except requests.exceptions.RequestException:
+            return False
+
+    def checkLoop(self):
+        while not self.stopped.wait(health_check_interval):
+            for endpoint in self.endpoints:
+                ok = self.check(endpoint)
+                if ok and not endpoint.healthy:
+                    endpoint.healthy = True
+                    print(f"{Highlight.GREEN}后端已恢复：{Highlight.RESET}{endpoint.host}")
+                elif not ok and endpoint.healthy:
+                    self.markDown(endpoint)
+
+    def start(self):
+        if len(self.endpoints) > 1 and self.checker is None:
+            self.checker = threading.Thread(target=self.checkLoop, daemon=True)
+            self.checker.start()
+
+    def stop(self):
+        self.stopped.set()
+        # 等待进行中的健康检查结束，避免它在日志关闭后还在输出
+        if self.checker is not None:
+            self.checker.join()
+            self.checker = None
+
+
+# 全局共享的后端池，首次使用时创建
+shared_pool = None
+
+
+def getPool() -> BackendPool:
+    global shared_pool
+    transport = getTransport()
+    with transport_lock:
+        if shared_pool is None:
+            parts = urlsplit(API_URL.chat)
+            endpoints = ollama_endpoints or [
+                (f"{parts.scheme}://{parts.netloc}", pool_size)
+            ]
+            shared_pool = BackendPool(endpoints, transport)
+            shared_pool.start()
+        return shared_pool
+
+
+class OllamaClient:
+    def __init__(self, transport: Transport = None, pool: BackendPool = None):
+        self.transport = transport or getTransport()
+        self.pool = pool or getPool()
+        # 本对话绑定的后端
+        self.endpoint = None
+        # 最近一次请求的完整返回，含prompt_eval_count等统计字段
+        self.lastData = {}
+        # 最近一次请求的首字延迟、总耗时（秒）和中止原因
+        self.lastTTFT = None
+        self.lastTotal = None
+        self.lastStopped = ""
+
+    def chat(
+        self,
+        payload: dict,
+        max_chars: int = 0,
+        max_seconds: float = 0,
+        max_lines: int = 0,
+    ) -> str:
+        """发送对话请求；流式时可按字数、时间、行数提前中止"""
+        return self.request(API_URL.chat, payload, max_chars, max_seconds, max_lines)
+
+    def generate(
+        self,
+        payload: dict,
+        max_chars: int = 0,
+        max_seconds: float = 0,
+        max_lines: int = 0,
+    ) -> str:
+        """发送续写请求，返回的context在lastData中，供下一句接着使用"""
+        return self.request(
+            API_URL.generate, payload, max_chars, max_seconds, max_lines
+        )
+
+    def request(
+        self, url: str, payload: dict, max_chars: int, max_seconds: float, max_lines: int
+    ) -> str:
+        self.lastTTFT = None
+        self.lastStopped = ""
+        start = time.perf_counter()
+
+        def read(response):
+            if payload.get("stream"):
+                return self.readStream(
+                    response, start, max_chars, max_seconds, max_lines
+                )
             data = response.json()
+            self.lastData = data
+            if "response" in data:
+                return data["response"]
             message = data.get("message")
             if not message or "content" not in message:
                 raise ValueError("API返回格式异常，缺少message或content")
             return message["content"]
+
+        try:
+            content = self.send(url, payload, read)
+            self.lastTotal = time.perf_counter() - start
+            return content
+        except requests.exceptions.RequestException as e:
+            raise ConnectionError(f"网络请求失败：{e}") from e
+        except json.JSONDecodeError as e:
+            raise ValueError(f"解析JSON失败：{e}") from e
+
+    def embed(self, model: str, texts: list) -> list:
+        """批量向量化，返回与texts一一对应的向量"""
+
+        def read(response):
+            embeddings = response.json().get("embeddings")
+            if not embeddings or len(embeddings) != len(texts):
+                raise ValueError("API返回格式异常，缺少embeddings")
+            return embeddings
+
+        payload = {"model": model, "input": texts, "keep_alive": keep_alive}
+        try:
+            return self.send(API_URL.embeddings, payload, read)
         except requests.exceptions.RequestException as e:
             raise ConnectionError(f"网络请求失败：{e}") from e
         except json.JSONDecodeError as e:
             raise ValueError(f"解析JSON失败：{e}") from e
 
+    def send(self, url: str, payload: dict, read):
+        """发往本对话绑定的后端，read(response)在占用并发名额期间读取结果；
+        后端失效时换一个可用后端重发"""
+        tried = []
+        while True:
+            if self.endpoint is None or not self.endpoint.healthy:
+                endpoint = self.pool.pin(self.endpoint, exclude=tried)
+                if endpoint is None:
+                    raise ConnectionError("没有可用的后端")
+                self.endpoint = endpoint
+            endpoint = self.endpoint
+            self.pool.acquire(endpoint)
+            try:
+                response = self.transport.post(
+                    endpoint.url(url),
+                    payload,
+                    stream=bool(payload.get("stream")),
+                    breaker=endpoint.breaker,
+                )
+                return read(response)
+            except ConnectionError:
+                tried.append(endpoint)
+                self.pool.markDown(endpoint)
+                if endpoint.healthy:
+                    raise  # 已是最后一个可用后端
+            finally:
+                self.pool.release(endpoint)
+
+    def close(self):
+        """对话结束，释放绑定的后端"""
+        if self.endpoint:
+            self.pool.unpin(self.endpoint)
+            self.endpoint = None
+
+    def readStream(self, response, start, max_chars, max_seconds, max_lines) -> str:
+        """逐块读取NDJSON流，违反限制时关闭连接并返回已生成的部分"""
+        pieces = []
+        length = 0
+        self.lastData = {}
+        try:
+            for raw in response.iter_lines():
+                if not raw:
+                    continue
+                chunk = json.loads(raw)
+                if "error" in chunk:
+                    raise ValueError(f"API返回错误：{chunk['error']}")
+                # /api/chat的内容在message中，/api/generate的在response中
+                if "response" in chunk:
+                    piece = chunk["response"]
+                else:
+                    piece = chunk.get("message", {}).get("content", "")
+                if piece:
+                    if self.lastTTFT is None:
+                        self.lastTTFT = time.perf_counter() - start
+                    pieces.append(piece)
+                    length += len(piece)
+                if chunk.get("done"):
+                    self.lastData = chunk
+                    break
+                # 超出行数：模型开始解释而不是翻译
+                if max_lines and "\n" in piece:
+                    if "".join(pieces).strip().count("\n") >= max_lines:
+                        self.lastStopped = "行数超出"
+                        break
+                if max_chars and length > max_chars:
+                    self.lastStopped = "字数超出"
+                    break
+                if max_seconds and time.perf_counter() - start > max_seconds:
+                    self.lastStopped = "生成超时"
+                    break
+        finally:
+            response.close()
+        content = "".join(pieces)
+        if self.lastStopped == "行数超出":
+            # 只保留约定行数内的内容
+            content = "\n".join(content.strip().splitlines()[:max_lines])
+        return content
+
+
+class TranslationMemory:
+    """SQLite翻译记忆，键为 模型+提示词哈希+原文+前文哈希"""
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = None,
+        ignore_context: bool = None,
+    ):
+        self.max_entries = memory_max_entries if max_entries is None else max_entries
+        self.ignore_context = (
+            memory_ignore_context if ignore_context is None else ignore_context
+        )
+        self.hits = 0
+        self.misses = 0
+        # 多个文件并发时共用同一个连接
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS memory ("
+            "key TEXT PRIMARY KEY, translation TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS memory_last_used ON memory(last_used)"
+        )
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COUNT(*) FROM memory").fetchone()[0]
+
+    @staticmethod
+    def hashText(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def makeKey(self, model: str, prompt: str, line: str, context: list) -> str:
+        context_hash = "" if self.ignore_context else self.hashText("\n".join(context))
+        return self.hashText(
+            "\0".join([model, self.hashText(prompt), line.strip(), context_hash])
+        )
+
+    def get(self, key: str):
+        """精确查找，未命中返回None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT translation FROM memory WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute(
+                "UPDATE memory SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self.conn.commit()
+            return row[0]
+
+    def put(self, key: str, translation: str):
+        with self.lock:
+            now = time.time()
+            updated = self.conn.execute(
+                "UPDATE memory SET translation = ?, last_used = ? WHERE key = ?",
+                (translation, now, key),
+            ).rowcount
+            if not updated:
+                self.conn.execute(
+                    "INSERT INTO memory (key, translation, last_used) VALUES (?, ?, ?)",
+                    (key, translation, now),
+                )
+                self.size += 1
+            # 超出容量时一次淘汰一成，避免每次写入都删除
+            if self.size > self.max_entries:
+                evict = self.size - self.max_entries + self.max_entries // 10
+                self.conn.execute(
+                    "DELETE FROM memory WHERE key IN "
+                    "(SELECT key FROM memory ORDER BY last_used LIMIT ?)",
+                    (evict,),
+                )
+                self.size = self.conn.execute(
+                    "SELECT COUNT(*) FROM memory"
+                ).fetchone()[0]
+            self.conn.commit()
+
+    def report(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        print(
+            f"{Highlight.BLUE}翻译记忆：{Highlight.RESET}命中{self.hits}次，"
+            f"未命中{self.misses}次，命中率{rate:.1f}%，共{self.size}条"
+        )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def openMemory():
+    """按配置打开全局翻译记忆"""
+    global translation_memory
+    if use_memory and translation_memory is None:
+        translation_memory = TranslationMemory(os.path.join(cache_folder, memory_file))
+    return translation_memory
+
+
+class Journal:
+    """单个文件的断点记录（JSONL）：首行为原文哈希，之后每行为一批完成的字幕"""
+
+    def __init__(self, path: str, source_hash: str):
+        self.path = path
+        self.source_hash = source_hash
+        # 已完成的 字幕序号 -> 译文
+        self.units = {}
+        # 用于重建上下文的对话记录 [角色, 内容]
+        self.messages = []
+        self.done = False
+        self.file = None
+        self.load()
+
+    def load(self):
+        """读取已有记录，原文变化时作废"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+        records = []
+        for raw in lines:
+            try:
+                records.append(json.loads(raw))
+            except json.JSONDecodeError:
+                break  # 崩溃时写了一半的记录
+        header = records[0] if records else {}
+        if (
+            header.get("source_hash") != self.source_hash
+            or header.get("version") != JOURNAL_VERSION
+        ):
+            return
+        for record in records[1:]:
+            for index, translation in record.get("units", {}).items():
+                self.units[int(index)] = translation
+            self.messages.extend(record.get("messages", []))
+            if record.get("done"):
+                self.done = True
+
+    def open(self):
+        creatFolder(os.path.dirname(self.path))
+        if self.units or self.done:
+            self.file = open(self.path, "a", encoding="utf-8")
+        else:
+            # 重新开始，写入原文哈希
+            self.file = open(self.path, "w", encoding="utf-8")
+            self.write({"source_hash": self.source_hash, "version": JOURNAL_VERSION})
+
+    def write(self, record: dict):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def record(self, units: dict, messages: list):
+        """记录一批完成的翻译和对应的新增对话"""
+        self.units.update(units)
+        self.write(
+            {
+                "units": {str(k): v for k, v in units.items()},
+                "messages": [[m.role, m.get_content()] for m in messages],
+            }
+        )
+
+    def finish(self):
+        self.done = True
+        self.write({"done": True})
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def hashFile(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def journalPath(origin_file_path: str) -> str:
+    relative_path = getRelativePath(origin_file_path, origin_folder)
+    return os.path.join(cache_folder, "journal", relative_path + ".journal")
+
+
+class AhoCorasick:
+    """Aho-Corasick多模式匹配：一次扫描找出文本中出现的全部术语"""
+
+    def __init__(self, words):
+        # 每个状态的转移、失配指针和匹配到的词
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for word in words:
+            self.add(word)
+        self.build()
+
+    def add(self, word: str):
+        state = 0
+        for ch in word:
+            next_state = self.goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][ch] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            state = next_state
+        self.output[state].append(word)
+
+    def build(self):
+        """按层次遍历建立失配指针，并合并后缀状态的输出"""
+        queue_ = list(self.goto[0].values())
+        for state in queue_:
+            for ch, next_state in self.goto[state].items():
+                queue_.append(next_state)
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(ch, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                self.output[next_state] = (
+                    self.output[next_state] + self.output[self.fail[next_state]]
+                )
+
+    def search(self, text: str) -> list:
+        """按出现顺序返回匹配到的词，不重复"""
+        found = []
+        seen = set()
+        state = 0
+        for ch in text:
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            for word in self.output[state]:
+                if word not in seen:
+                    seen.add(word)
+                    found.append(word)
+        return found
+
+
+class Glossary:
+    """系列术语表：只把当前字幕命中的条目注入请求，并检查译文是否用了锁定译名"""
+
+    def __init__(self, entries: dict):
+        self.entries = entries
+        self.automaton = AhoCorasick(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def match(self, text: str) -> list:
+        return [(word, self.entries[word]) for word in self.automaton.search(text)]
+
+    @staticmethod
+    def hint(matches: list) -> str:
+        if not matches:
+            return ""
+        terms = "；".join(f"{source}→{target}" for source, target in matches)
+        return f"（指定译名：{terms}）\n"
+
+    @staticmethod
+    def missing(matches: list, translation: str) -> list:
+        """译文中没有出现的锁定译名"""
+        return [(s, t) for s, t in matches if t not in translation]
+
+
+def readGlossary(path: str) -> dict:
+    entries = {}
+    with open(path, "r", encoding="utf-8-sig") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            source, sep, target = line.partition("=")
+            if not sep:
+                source, sep, target = line.partition("\t")
+            if sep and source.strip() and target.strip():
+                entries[source.strip()] = target.strip()
+    return entries
+
+
+# 已编译的术语表：(文件路径, 修改时间)元组 -> Glossary
+glossary_cache = {}
+glossary_lock = threading.Lock()
+
+
+def loadGlossary(origin_file_path: str):
+    """合并从原文件夹根目录到文件所在目录的全部术语表，没有时返回None"""
+    folders = []
+    folder = os.path.dirname(os.path.abspath(origin_file_path))
+    root = os.path.abspath(origin_folder)
+    while True:
+        folders.append(folder)
+        if folder == root or os.path.dirname(folder) == folder:
+            break
+        folder = os.path.dirname(folder)
+    paths = [
+        os.path.join(f, glossary_name)
+        for f in reversed(folders)
+        if os.path.isfile(os.path.join(f, glossary_name))
+    ]
+    if not paths:
+        return None
+    key = tuple((path, os.path.getmtime(path)) for path in paths)
+    with glossary_lock:
+        if key not in glossary_cache:
+            entries = {}
+            for path in paths:
+                entries.update(readGlossary(path))
+            glossary_cache[key] = Glossary(entries)
+        return glossary_cache[key]
+
+
+class RetrievalIndex:
+    """系列的向量索引：已译的原文/译文对及原文向量，按系列保存在缓存文件夹"""
+
+    def __init__(self, path: str):
+        self.path = path
+        # 同一系列的多个文件并发时共用
+        self.lock = threading.Lock()
+        self.sources = []
+        self.translations = []
+        # 原文 -> 行号，同一原文只保留最新译文
+        self.rows = {}
+        # 单位化后的向量，按需倍增容量
+        self.vectors = None
+        self.count = 0
+        self.dirty = False
+        self.load()
+
+    def __len__(self):
+        return self.count
+
+    def load(self):
+        """读取已保存的索引，向量模型变化或文件损坏时重新建立"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path) as data:
+                if str(data["model"]) != embed_model:
+                    return
+                vectors = data["vectors"].astype(np.float32)
+                sources = data["sources"].tolist()
+                translations = data["translations"].tolist()
+        except (OSError, ValueError, KeyError):
+            return
+        self.sources = sources
+        self.translations = translations
+        self.rows = {source: row for row, source in enumerate(sources)}
+        # 空索引保存为(0, 0)的数组，按未建立处理，首次加入时再按向量维度分配
+        self.vectors = vectors if len(vectors) else None
+        self.count = len(sources)
+
+    def add(self, source: str, translation: str, vector):
+        with self.lock:
+            row = self.rows.get(source)
+            if row is not None:
+                if self.translations[row] != translation:
+                    self.translations[row] = translation
+                    self.dirty = True
+                return
+            norm = np.linalg.norm(vector)
+            if not norm:
+                return
+            if self.vectors is None:
+                self.vectors = np.empty((64, len(vector)), dtype=np.float32)
+            elif self.count == len(self.vectors):
+                grown = np.empty((self.count * 2, self.vectors.shape[1]), dtype=np.float32)
+                grown[: self.count] = self.vectors[: self.count]
+                self.vectors = grown
+            self.vectors[self.count] = vector / norm
+            self.rows[source] = self.count
+            self.sources.append(source)
+            self.translations.append(translation)
+            self.count += 1
+            self.dirty = True
+
+    def vector(self, source: str):
+        """已收录原文的向量，没有时返回None"""
+        with self.lock:
+            row = self.rows.get(source)
+            return None if row is None else self.vectors[row].copy()
+
+    def search(self, vector, k: int) -> list:
+        """返回最相似的k条 (相似度, 原文, 译文)，按相似度从高到低"""
+        with self.lock:
+            if not self.count or self.vectors.shape[1] != len(vector):
+                return []
+            norm = np.linalg.norm(vector)
+            if not norm:
+                return []
+            scores = self.vectors[: self.count] @ (vector / norm)
+            k = min(k, self.count)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [
+                (float(scores[row]), self.sources[row], self.translations[row])
+                for row in top
+            ]
+
+    def save(self):
+        """原子写入，避免留下写了一半的索引"""
+        with self.lock:
+            if not self.dirty:
+                return
+            creatFolder(os.path.dirname(self.path))
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "wb") as f:
+                np.savez(
+                    f,
+                    model=np.array(embed_model),
+                    sources=np.array(self.sources, dtype=str),
+                    translations=np.array(self.translations, dtype=str),
+                    vectors=self.vectors[: self.count]
+                    if self.count
+                    else np.empty((0, 0), dtype=np.float32),
+                )
+            os.replace(temp_path, self.path)
+            self.dirty = False
+
+
+# 已打开的向量索引：索引文件路径 -> RetrievalIndex
+retrieval_indexes = {}
+retrieval_lock = threading.Lock()
+
+
+def loadRetrieval(origin_file_path: str):
+    """文件所在系列（文件夹）的向量索引，未启用检索上下文时返回None"""
+    if not use_retrieval or np is None:
+        return None
+    series = getRelativePath(os.path.dirname(origin_file_path), origin_folder)
+    path = os.path.join(cache_folder, "retrieval", series, "index.npz")
+    with retrieval_lock:
+        if path not in retrieval_indexes:
+            retrieval_indexes[path] = RetrievalIndex(path)
+        return retrieval_indexes[path]
+
+
+class ModelManager:
+    """模型生命周期：启动时在每个后端预加载，运行期间常驻，结束时卸载"""
+
+    def __init__(self):
+        self.loaded = []
+
+    def models(self) -> list:
+        models = [Models.default_model]
+        if use_routing and light_model not in models:
+            models.append(light_model)
+        # 校验重试会换用备用模型，同样预加载并在结束时卸载
+        if use_validation and validation_retries > 1 and fallback_model not in models:
+            models.append(fallback_model)
+        if use_retrieval and np is not None:
+            models.append(embed_model)
+        return models
+
+    def request(self, endpoint: Endpoint, model: str, alive) -> dict:
+        """空消息的对话请求只加载/卸载模型，不做推理；向量模型用空输入"""
+        if model == embed_model:
+            url = API_URL.embeddings
+            payload = {"model": model, "input": [], "keep_alive": alive}
+        else:
+            url = API_URL.chat
+            # 带上与翻译请求相同的参数，否则首个翻译请求会按新参数重新加载
+            payload = {
+                "model": model,
+                "messages": [],
+                "options": modelOptions(),
+                "keep_alive": alive,
+            }
+        response = getTransport().post(
+            endpoint.url(url), payload, breaker=endpoint.breaker
+        )
+        return response.json()
+
+    def preload(self):
+        for endpoint in getPool().healthy():
+            for model in self.models():
+                start = time.perf_counter()
+                try:
+                    data = self.request(endpoint, model, keep_alive)
+                except (ConnectionError, requests.exceptions.RequestException) as e:
+                    print(f"{Highlight.RED}预加载失败：{Highlight.RESET}{model} {e}")
+                    continue
+                elapsed = time.perf_counter() - start
+                metrics.record(data, elapsed, model=model, kind="load")
+                if (endpoint, model) not in self.loaded:
+                    self.loaded.append((endpoint, model))
+                print(
+                    f"{Highlight.BLUE}预加载模型：{Highlight.RESET}{model}@{endpoint.host}，"
+                    f"耗时{elapsed:.2f}秒（加载{(data.get("load_duration") or 0) / 1e9:.2f}秒）"
+                )
+
+    def unload(self):
+        for endpoint, model in self.loaded:
+            try:
+                self.request(endpoint, model, 0)
+            except (ConnectionError, requests.exceptions.RequestException):
+                continue  # 服务已停止时无需卸载
+        self.loaded = []
+
+
+# 全局模型管理
+model_manager = ModelManager()
+
+
+class Router:
+    """按廉价特征分流字幕，并统计每条路线的条数和耗时"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # 路线 -> [条数, 累计秒数]
+        self.stats = {}
+
+    def lookup(self, text: str):
+        """查静态表，命中时保留原句尾标点"""
+        normalized = normalizeLine(text)
+        core = normalized.rstrip(TRAILING_PUNCT)
+        translation = STATIC_TRANSLATIONS.get(core)
+        if translation is None:
+            return None
+        # 规范化会把全角标点转成半角，这里转回中文标点
+        tail = normalized[len(core) :].replace(" ", "")
+        tail = tail.replace("...", "……").replace("?", "？").replace("!", "！")
+        return translation + tail.replace("~", "～")
+
+    def classify(self, text: str) -> str:
+        core = normalizeLine(text).rstrip(TRAILING_PUNCT)
+        if len(core) <= light_max_length and KANA_PATTERN.match(core):
+            return Route.light
+        return Route.heavy
+
+    def record(self, route: str, count: int, seconds: float):
+        if count <= 0:
+            return
+        with self.lock:
+            stat = self.stats.setdefault(route, [0, 0.0])
+            stat[0] += count
+            stat[1] += seconds
+
+    def report(self):
+        for route, (count, seconds) in self.stats.items():
+            average = seconds / count * 1000 if count else 0
+            print(
+                f"{Highlight.BLUE}{route}：{Highlight.RESET}{count}条，"
+                f"平均{average:.0f}毫秒/条"
+            )
+
+
+# 全局分流统计
+router = Router()
+
+
+class MetricsAggregate:
+    """一组请求的汇总：token数、各阶段耗时和延迟分布"""
+
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.eval_tokens = 0
+        # Ollama返回的耗时，单位纳秒
+        self.prompt_ns = 0
+        self.eval_ns = 0
+        self.load_ns = 0
+        self.load_stalls = 0
+        self.latencies = []
+
+    def add(self, record: dict):
+        self.requests += 1
+        self.prompt_tokens += record["prompt_eval_count"]
+        self.eval_tokens += record["eval_count"]
+        self.prompt_ns += record["prompt_eval_duration"]
+        self.eval_ns += record["eval_duration"]
+        self.load_ns += record["load_duration"]
+        if record["load_duration"] > load_stall_seconds * 1e9:
+            self.load_stalls += 1
+        self.latencies.append(record["latency"])
+
+    def summary(self) -> dict:
+        busy_ns = self.prompt_ns + self.eval_ns
+        return {
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "eval_tokens": self.eval_tokens,
+            "prompt_tokens_per_sec": (
+                round(self.prompt_tokens / self.prompt_ns * 1e9, 1)
+                if self.prompt_ns
+                else 0
+            ),
+            "eval_tokens_per_sec": (
+                round(self.eval_tokens / self.eval_ns * 1e9, 1) if self.eval_ns else 0
+            ),
+            # 提示词处理占模型耗时的比例，其余为生成
+            "prompt_share": round(self.prompt_ns / busy_ns, 3) if busy_ns else 0,
+            "load_seconds": round(self.load_ns / 1e9, 3),
+            "load_stalls": self.load_stalls,
+            "latency_p50": round(percentile(self.latencies, 0.5), 3),
+            "latency_p95": round(percentile(self.latencies, 0.95), 3),
+        }
+
+
+class Metrics:
+    """逐请求采集Ollama的统计字段，按文件和整次运行汇总，导出JSONL"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.run = MetricsAggregate()
+        # 预加载/卸载请求单独统计，不计入翻译延迟
+        self.loads = MetricsAggregate()
+        self.files = {}
+        self.file = None
+        self.started = time.time()
+        # 其他模块上报的即时数值，如队列长度
+        self.gauges = {}
+
+    def open(self, path: str):
+        self.file = open(path, "a", encoding="utf-8")
+
+    def write(self, record: dict):
+        if self.file:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def record(
+        self,
+        data: dict,
+        latency: float,
+        ttft: float = None,
+        model: str = "",
+        label: str = "",
+        kind: str = "chat",
+    ):
+        """记录一次请求，data为Ollama返回的最后一块数据"""
+        record = {
+            "type": kind,
+            "time": round(time.time(), 3),
+            "file": label,
+            "model": model,
+            "latency": round(latency or 0, 4),
+            "ttft": round(ttft, 4) if ttft is not None else None,
+        }
+        for field in (
+            "prompt_eval_count",
+            "prompt_eval_duration",
+            "eval_count",
+            "eval_duration",
+            "load_duration",
+            "total_duration",
+        ):
+            record[field] = data.get(field, 0) or 0
+        with self.lock:
+            if kind != "chat":
+                self.loads.add(record)
+                self.write(record)
+                return
+            self.run.add(record)
+            if label:
+                self.files.setdefault(label, MetricsAggregate()).add(record)
+            self.write(record)
+
+    def finishFile(self, label: str) -> dict:
+        """输出并写入单个文件的汇总"""
+        with self.lock:
+            aggregate = self.files.pop(label, None)
+            if aggregate is None:
+                return {}
+            summary = aggregate.summary()
+            self.write({"type": "file", "file": label, **summary})
+        self.print(summary, f"文件指标（{label}）")
+        return summary
+
+    def finishRun(self) -> dict:
+        with self.lock:
+            summary = self.run.summary()
+            summary["seconds"] = round(time.time() - self.started, 1)
+            summary["preloads"] = self.loads.requests
+            summary["preload_seconds"] = round(self.loads.load_ns / 1e9, 3)
+            self.write({"type": "run", **summary})
+        self.print(summary, "运行指标")
+        return summary
+
+    def print(self, summary: dict, title: str):
+        if not summary.get("requests"):
+            return
+        print(
+            f"{Highlight.BLUE}{title}：{Highlight.RESET}{summary['requests']}次请求，"
+            f"生成{summary['eval_tokens_per_sec']}token/秒，"
+            f"提示词{summary['prompt_tokens_per_sec']}token/秒"
+            f"（占{summary['prompt_share'] * 100:.0f}%），"
+            f"延迟p50 {summary['latency_p50']}秒/p95 {summary['latency_p95']}秒，"
+            f"模型加载{summary['load_stalls']}次共{summary['load_seconds']}秒"
+            + (
+                f"，预加载{summary['preloads']}次共{summary['preload_seconds']}秒"
+                if "preloads" in summary
+                else ""
+            )
+        )
+
+    def prometheus(self) -> str:
+        """Prometheus文本格式"""
+        with self.lock:
+            run = self.run
+            latencies = list(run.latencies)
+            gauges = dict(self.gauges)
+            lines = [
+                ("translator_requests_total", "counter", run.requests),
+                ("translator_prompt_tokens_total", "counter", run.prompt_tokens),
+                ("translator_eval_tokens_total", "counter", run.eval_tokens),
+                ("translator_prompt_seconds_total", "counter", run.prompt_ns / 1e9),
+                ("translator_eval_seconds_total", "counter", run.eval_ns / 1e9),
+                ("translator_load_seconds_total", "counter", run.load_ns / 1e9),
+                ("translator_load_stalls_total", "counter", run.load_stalls),
+                (
+                    "translator_preload_seconds_total",
+                    "counter",
+                    self.loads.load_ns / 1e9,
+                ),
+                ("translator_cues_translated_total", "counter", translated_cues),
+                ("translator_uptime_seconds", "gauge", time.time() - self.started),
+            ]
+        text = []
+        for name, kind, value in lines:
+            text.append(f"# TYPE {name} {kind}")
+            text.append(f"{name} {value}")
+        text.append("# TYPE translator_request_latency_seconds summary")
+        for q in (0.5, 0.95):
+            text.append(
+                f'translator_request_latency_seconds{{quantile="{q}"}} '
+                f"{percentile(latencies, q)}"
+            )
+        for name, value in gauges.items():
+            text.append(f"# TYPE translator_{name} gauge")
+            text.append(f"translator_{name} {value}")
+        return "\n".join(text) + "\n"
+
+    def serve(self, port: int, host: str = None):
+        """在后台线程开启 /metrics 端点"""
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                body = owner.prometheus().encode("utf-8")
+                self.send_response(200 if self.path == "/metrics" else 404)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer((host or metrics_host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+# 全局运行指标
+metrics = Metrics()
+
 
 class AI:
     def __init__(self, model: str = Models.default_model):
         # 类成员属性
         self.model = model
         self.client = OllamaClient()
+        # 指标中标记所属文件
+        self.label = ""
+        self.memory = translation_memory
         self.messages = []
+        # 被裁掉的旧译文摘要
+        self.summaryLines = []
+        self.summaryMess = None
+        # 断点记录，以及尚未写入记录的新对话
+        self.journal = None
+        self.newMessages = []
+        # 当前文件所属系列的术语表及违规次数
+        self.glossary = None
+        self.glossaryMisses = 0
+        # 系列的向量索引、本文件原文的向量缓存和本次请求的参考译文
+        self.retrieval = None
+        self.vectors = {}
+        self.retrievedMess = None
+        # 分流时处理短句的小模型，首次使用时创建
+        self.light = None
+        self.memoryHits = 0
+        # 批量翻译统计
+        self.batchedLines = 0
+        self.fallbackLines = 0
+        # 校验：重试队列(序号, 原文, 原因)、未通过的译文、原因统计，以及校验重试用的备用模型
+        self.retryQueue = []
+        self.rejected = {}
+        self.failureReasons = Counter()
+        self.retryFixed = 0
+        self.unresolved = 0
+        self.failedRequests = 0
+        self.lastError = ""
+        # 上次失败是否因生成跑偏被中止（字数超出/生成超时），这类失败按校验未通过处理
+        self.lastCut = ""
+        self.fallback = None
+        # 场景并行时保护上面的统计和断点记录
+        self.lock = threading.Lock()
+        # generate接口：上一句返回的context，以及本次请求前的context（撤回对话时恢复）
+        self.context = None
+        self.contextBefore = None
+        self.rebases = 0
         # 添加系统提示词
         systemPrompt = Message(Role.system, systemPrompt_str)
         self.addMess(systemPrompt)
 
     def addMess(self, mess: Message):
         self.messages.append(mess)
+        if self.journal:
+            self.newMessages.append(mess)
+
+    def dropLastMessages(self, count: int):
+        """撤回最近的几条对话记录"""
+        del self.messages[-count:]
+        if self.journal:
+            del self.newMessages[-count:]
+        # 撤回的内容可能已进入context，退回到请求之前
+        self.context = self.contextBefore
+
+    def resume(self, journal: Journal):
+        """从断点记录重建上下文，并在之后的翻译中持续记录"""
+        for role, content in journal.messages:
+            self.addMess(Message(role, content))
+        self.trim_history()
+        self.journal = journal
+
+    def promptTokens(self) -> int:
+        """估算当前要发送的全部消息的token数"""
+        return sum(estimateMessageTokens(m) for m in self.contextMessages())
+
+    def contextMessages(self) -> list:
+        """实际发送的消息：有参考译文时放在系统提示词之后"""
+        if self.retrievedMess is None:
+            return self.messages
+        return self.messages[:1] + [self.retrievedMess] + self.messages[1:]
 
     def trim_history(self):
-        # 最大存储对话记录条数
-        maxMess = 100
-        if len(self.messages) > maxMess + 1:
-            system_msg = self.messages[0]
-            recent_msgs = self.messages[-maxMess:]
-            self.messages = [system_msg] + recent_msgs
-
-    def translate(self) -> bool:
+        """按token预算保留最近的对话，超出部分淘汰或压缩为摘要"""
+        budget = int(num_ctx * context_budget_ratio)
+        start = 2 if self.summaryMess else 1
+        if self.retrieval is not None:
+            # 检索上下文只保留最近几轮，更早的内容按相似度取回
+            keep = retrieval_recent * 2 + (self.messages[-1].role == Role.user)
+            del self.messages[start : max(start, len(self.messages) - keep)]
+        if self.promptTokens() <= budget:
+            return
+        used = sum(estimateMessageTokens(m) for m in self.messages[:start])
+        # 从最新的消息往前累加，最新一条无论如何都保留
+        keep_from = len(self.messages) - 1
+        used += estimateMessageTokens(self.messages[keep_from])
+        while keep_from > start:
+            cost = estimateMessageTokens(self.messages[keep_from - 1])
+            if used + cost > budget:
+                break
+            used += cost
+            keep_from -= 1
+        # 按轮次淘汰，保留部分从用户消息开始
+        while (
+            keep_from < len(self.messages) - 1
+            and self.messages[keep_from].role != Role.user
+        ):
+            keep_from += 1
+        evicted = self.messages[start:keep_from]
+        self.messages = self.messages[:start] + self.messages[keep_from:]
+        if history_summary:
+            self.summarize(evicted)
+
+    def summarize(self, evicted: list):
+        """把被淘汰的译文压缩成前文摘要，只保留最近的部分"""
+        for mess in evicted:
+            if mess.role != Role.ai:
+                continue
+            for line in mess.get_content().splitlines():
+                match = BATCH_LINE_PATTERN.match(line)
+                line = match.group(2) if match else line.strip()
+                if line:
+                    self.summaryLines.append(line)
+        while (
+            self.summaryLines
+            and estimateTokens("\n".join(self.summaryLines)) > summary_max_tokens
+        ):
+            self.summaryLines.pop(0)
+        if not self.summaryLines:
+            return
+        content = "前文译文摘要（保持称呼和译名一致）：\n" + "\n".join(self.summaryLines)
+        if self.summaryMess:
+            self.summaryMess.content = content
+        else:
+            self.summaryMess = Message(Role.system, content)
+            self.messages.insert(1, self.summaryMess)
+
+    def translate(self, source_length: int, max_lines: int = 1) -> bool:
+        """source_length为原文字数，不含提示词和术语提示，用于限制生成长度"""
+        self.lastCut = ""
         try:
+            # 发送前确保不超出预算
+            self.trim_history()
+            estimated = self.promptTokens()
+            # 按原文长度限制生成长度
+            max_chars = int(source_length * stream_length_ratio) + stream_length_slack
             payload = {
                 "model": self.model,
-                "messages": [m.to_dict() for m in self.messages],
-                "options": {
-                    "num_ctx": 8192,  # 上下文窗口
-                    "temperature": 0.7,  # 生成温度/发散度
-                    "num_gpu": -1,  # GPU层数，-1强制用满GPU
-                    "num_thread": 16,  # CPU线程数，填内核/逻辑线程数量
-                    "num_batch": 128,  # 批量推理大小，根据显存推算
-                    "repeat_penalty": 1.05,  # 重复惩罚，1为默认值
-                    "top_k": 20,  # 候选词数量，20为默认值
-                    "top_p": 0.95,  # 核采样阈值，0.95为默认值
-                },
-                "stream": False,  # 流式输出
+                "messages": [m.to_dict() for m in self.contextMessages()],
+                "options": modelOptions(),
+                "stream": use_stream,  # 流式输出
                 "think": False,  # qwen2不支持think参数，qwen3支持
-                "keep_alive": "3m",  # 生成内容后停留内存的时间
+                "keep_alive": keep_alive,  # 生成内容后停留内存的时间
             }
-            response = self.client.chat(payload)
+            self.contextBefore = self.context
+            if engine == "generate":
+                response = self.client.generate(
+                    self.generatePayload(payload), max_chars, stream_max_seconds, max_lines
+                )
+                self.updateContext()
+            else:
+                response = self.client.chat(
+                    payload, max_chars, stream_max_seconds, max_lines
+                )
+            stopped = self.client.lastStopped
+            if stopped in ("字数超出", "生成超时"):
+                # 跑偏或超时的生成不能当作译文，只有按行数截断的结果可用
+                self.lastCut = stopped
+                raise ValueError(f"生成已中止（{stopped}）：{response[:40]}")
             self.addMess(Message(Role.ai, response))
-            print(f"译文：{response}")
+            metrics.record(
+                self.client.lastData,
+                self.client.lastTotal,
+                self.client.lastTTFT,
+                self.model,
+                self.label,
+            )
+            detail(f"译文：{response}")
+            if stopped:
+                detail(f"{Highlight.YELLOW}生成已截断：{Highlight.RESET}{stopped}")
+            # 上报本次请求的提示词token数和耗时，确认延迟不随行数增长
+            ttft = self.client.lastTTFT
+            detail(
+                f"{Highlight.BLUE}提示词：{Highlight.RESET}估算{estimated}token，"
+                f"实际{self.client.lastData.get("prompt_eval_count", "-")}token，"
+                + (f"首字{ttft:.2f}秒，" if ttft is not None else "")
+                + f"耗时{self.client.lastTotal:.2f}秒"
+            )
             return True
         except Exception as e:
             error_content = f"翻译失败：{str(e)}"
+            self.lastError = error_content
             self.addMess(Message(Role.ai, error_content))
             return False
+        finally:
+            self.retrievedMess = None
+
+    def generatePayload(self, payload: dict) -> dict:
+        """把对话请求改写为/api/generate：有context时只发送本句，
+        否则用系统提示词和最近几轮对话重新建立"""
+        payload = dict(payload)
+        del payload["messages"]
+        prompt = self.messages[-1].get_content()
+        if self.retrievedMess:
+            prompt = self.retrievedMess.get_content() + "\n" + prompt
+        if self.context:
+            payload["context"] = self.context
+        else:
+            system = [m.get_content() for m in self.messages[:-1] if m.role == Role.system]
+            turns = []
+            for mess in self.messages[1:-1]:
+                if mess.role == Role.user:
+                    turns.append([mess.get_content(), ""])
+                elif mess.role == Role.ai and turns:
+                    turns[-1][1] = mess.get_content()
+            turns = turns[-rebase_turns:] if rebase_turns else []
+            if turns:
+                system.append(
+                    "前文（保持称呼和译名一致）：\n"
+                    + "\n".join(f"{source} → {target}" for source, target in turns)
+                )
+            payload["system"] = "\n".join(system)
+        payload["prompt"] = prompt
+        return payload
+
+    def updateContext(self):
+        """保存返回的context；接近num_ctx或被中止没有返回时，下一句重新建立"""
+        context = self.client.lastData.get("context")
+        if context and len(context) < num_ctx * context_rebase_ratio:
+            self.context = context
+            return
+        if context:
+            self.rebases += 1
+            detail(f"{Highlight.BLUE}context已有{len(context)}token，下一句重新建立{Highlight.RESET}")
+        self.context = None
+
+    def embed(self, texts: list):
+        """批量向量化尚未缓存的原文，失败时这些行不带参考译文"""
+        if self.retrieval is None:
+            return
+        missing = []
+        for text in dict.fromkeys(texts):
+            if text in self.vectors:
+                continue
+            # 系列中已译过的原文直接复用索引里的向量
+            vector = self.retrieval.vector(text)
+            if vector is None:
+                missing.append(text)
+            else:
+                self.vectors[text] = vector
+        for start in range(0, len(missing), embed_batch_size):
+            chunk = missing[start : start + embed_batch_size]
+            try:
+                vectors = self.client.embed(embed_model, chunk)
+            except Exception as e:
+                print(f"{Highlight.YELLOW}向量化失败：{Highlight.RESET}{str(e)}")
+                return
+            for text, vector in zip(chunk, vectors):
+                self.vectors[text] = np.asarray(vector, dtype=np.float32)
+
+    def retrieve(self, lines: list):
+        """从系列索引中取出与本次原文最相似的已译句，作为本次请求的参考译文"""
+        self.retrievedMess = None
+        if self.retrieval is None:
+            return
+        self.embed(lines)
+        recent = {m.get_content() for m in self.messages[1:]}
+        found = {}
+        for line in lines:
+            vector = self.vectors.get(line)
+            if vector is None:
+                continue
+            for score, source, translation in self.retrieval.search(
+                vector, retrieval_top_k + len(lines)
+            ):
+                if score < retrieval_min_score or source in recent:
+                    continue
+                if score > found.get(source, (0, ""))[0]:
+                    found[source] = (score, translation)
+        best = sorted(found.items(), key=lambda item: -item[1][0])[:retrieval_top_k]
+        if best:
+            self.retrievedMess = Message(
+                Role.system,
+                "参考译文（保持称呼和译名一致）：\n"
+                + "\n".join(f"{source}→{translation}" for source, (_, translation) in best),
+            )
+
+    def index(self, pairs: list):
+        """把完成的(原文, 译文)加入系列索引"""
+        if self.retrieval is None:
+            return
+        for source, translation in pairs:
+            vector = self.vectors.get(source)
+            if vector is not None:
+                self.retrieval.add(source, translation, vector)
+
+    def close(self):
+        self.client.close()
+        if self.light:
+            self.light.close()
+        if self.fallback:
+            self.fallback.close()
 
     def getLastMessage(self) -> str:
         return self.messages[-1].get_content()
 
-    def shouldPass(self, line):
-        stripped_line = line.strip()
-        if not stripped_line:
-            return True  # 空行
-        if stripped_line.isdigit():
-            return True  # 序列行
-        if TIMESTAMP_PATTERN.match(line):
-            return True  # 时间戳行
-        return False  # 正常文本
-
-    def solveOneFile(self, ori_file, tra_file) -> bool:
-        lineCount = 1
-        for line in ori_file:
-            # 是否需要跳过
-            if self.shouldPass(line):
-                # 跳过
-                tra_file.write(line)  # 原封不动写入
+    def memoryKey(self, line: str):
+        """当前上下文下该行的翻译记忆键，未启用记忆时返回None"""
+        if self.memory is None:
+            return None
+        context = [m.get_content() for m in self.messages[1:]]
+        context = context[-memory_context_size:] if memory_context_size else []
+        return self.memory.makeKey(
+            self.model, self.messages[0].get_content(), line, context
+        )
+
+    def matchGlossary(self, line: str) -> list:
+        return self.glossary.match(line) if self.glossary else []
+
+    def checkGlossary(self, matches: list, translation: str):
+        missing = Glossary.missing(matches, translation)
+        if missing:
+            self.glossaryMisses += len(missing)
+            detail(
+                f"{Highlight.YELLOW}未使用锁定译名：{Highlight.RESET}"
+                + "；".join(f"{s}→{t}" for s, t in missing)
+            )
+        return missing
+
+    def translateLine(self, line: str, note: str = ""):
+        """翻译一条字幕（可含多行），失败返回None；note为只随本次请求发送的附加提示"""
+        # 只注入本句命中的术语
+        matches = self.matchGlossary(line)
+        content = note + Glossary.hint(matches) + line
+        key = self.memoryKey(content)
+        cached = self.memory.get(key) if key else None
+        # 添加记录（原文）
+        user = Message(Role.user, line)
+        self.addMess(user)
+        if cached is not None:
+            # 命中翻译记忆，无需请求模型
+            self.memoryHits += 1
+            self.addMess(Message(Role.ai, cached))
+            detail(f"译文（记忆）：{cached}")
+            self.trim_history()
+            return cached
+        # 翻译，术语提示只随本次请求发送，不留在历史中
+        self.retrieve([line])
+        user.content = content
+        ok = self.translate(len(line.strip()), max_lines=line.strip().count("\n") + 1)
+        user.content = line
+        if not ok:
+            # 撤回失败的这一轮，之后的字幕照常翻译
+            self.dropLastMessages(2)
+            return None
+        # 取出记录（译文）
+        processed_line = self.getLastMessage()
+        self.checkGlossary(matches, processed_line)
+        # 未通过校验的译文不进入翻译记忆
+        if key and not checkTranslation(line, processed_line):
+            self.memory.put(key, processed_line)
+        # 限制历史记录
+        self.trim_history()
+        return processed_line
+
+    def parseBatch(self, reply: str, count: int):
+        """把编号回复拆回各行，编号缺失或数量不符时返回None"""
+        results = {}
+        for reply_line in reply.splitlines():
+            match = BATCH_LINE_PATTERN.match(reply_line)
+            if not match:
+                if reply_line.strip():
+                    return None  # 混入了非编号内容
                 continue
-            # 处理
+            index = int(match.group(1))
+            if index in results or not 1 <= index <= count:
+                return None
+            results[index] = match.group(2).strip()
+        if len(results) != count:
+            return None
+        return [results[i] for i in range(1, count + 1)]
+
+    def translateBatch(self, lines: list):
+        """打包翻译多行，回复对不上时回退为逐行翻译，失败返回None"""
+        if len(lines) == 1:
+            result = self.translateLine(lines[0])
+            return None if result is None else [result]
+        matches = [self.matchGlossary(line) for line in lines]
+        # 整批都命中翻译记忆时不请求模型
+        keys = [
+            self.memoryKey(Glossary.hint(match) + line)
+            for match, line in zip(matches, lines)
+        ]
+        cached = [self.memory.get(key) for key in keys] if keys[0] else []
+        # 多行字幕在批量请求中用 / 连接
+        numbered = "".join(
+            f"{i}. {line.strip().replace("\n", " / ")}\n"
+            for i, line in enumerate(lines, 1)
+        )
+        content = batchPrompt_str.format(count=len(lines)) + numbered
+        # 合并本批命中的术语，只随本次请求发送
+        terms = list(dict.fromkeys(term for match in matches for term in match))
+        user = Message(Role.user, content)
+        self.addMess(user)
+        if cached and None not in cached:
+            reply = "\n".join(f"{i}. {text}" for i, text in enumerate(cached, 1))
+            self.memoryHits += len(lines)
+            self.addMess(Message(Role.ai, reply))
+            detail(f"译文（记忆）：{reply}")
+            self.trim_history()
+            return cached
+        self.retrieve(lines)
+        user.content = Glossary.hint(terms) + content
+        # 回复同样带编号，按编号后的原文计算长度上限
+        ok = self.translate(len(numbered.strip()), max_lines=len(lines))
+        user.content = content
+        if ok:
+            results = self.parseBatch(self.getLastMessage(), len(lines))
+            if results is not None:
+                for match, result in zip(matches, results):
+                    self.checkGlossary(match, result)
+                for key, line, result in zip(keys, lines, results):
+                    if key and not checkTranslation(line, result):
+                        self.memory.put(key, result)
+                self.batchedLines += len(lines)
+                self.trim_history()
+                return results
+            print(f"{Highlight.YELLOW}批量回复未对齐，改为逐行翻译{Highlight.RESET}")
+        else:
             print(
-                f"{Highlight.BLUE}{lineCount}.正在处理：{Highlight.RESET}{line}", end=""
+                f"{Highlight.YELLOW}批量翻译失败，改为逐行翻译：{Highlight.RESET}{self.getLastMessage()}"
             )
-            # 标记工作进度
-            lineCount = lineCount + 1
-            # 添加记录（原文）
-            self.addMess(Message(Role.user, line))
-            # 翻译
-            if not self.translate():
-                print(
-                    f"{Highlight.RED}翻译失败：{Highlight.RESET}{self.getLastMessage()}"
+        # 撤回本次批量的记录，避免错位的回复污染上下文
+        self.dropLastMessages(2)
+        results = []
+        for line in lines:
+            result = self.translateLine(line)
+            if result is None:
+                return None
+            results.append(result)
+        self.fallbackLines += len(lines)
+        return results
+
+    def translateUnits(self, todo: list):
+        """按路线翻译一批(序号, 原文)，返回 序号->译文，失败返回None"""
+        translated = {}
+        routes = {}
+        for index, text in todo:
+            # 统一译文和静态表不分系列，命中本系列术语表的行要注入并检查锁定译名，只交给模型
+            locked = bool(self.matchGlossary(text))
+            # 重复短句直接使用统一译文
+            shared = None if locked else shared_translations.get(normalizeLine(text))
+            if shared is not None:
+                translated[index] = shared
+                router.record(Route.shared, 1, 0)
+                continue
+            route = Route.heavy
+            if use_routing:
+                static = None if locked else router.lookup(text)
+                if static is not None:
+                    translated[index] = static
+                    router.record(Route.table, 1, 0)
+                    continue
+                route = router.classify(text)
+            routes.setdefault(route, []).append((index, text))
+        for route, items in routes.items():
+            if route == Route.light:
+                if self.light is None:
+                    self.light = AI(light_model)
+                    self.light.label = self.label
+                    self.light.glossary = self.glossary
+                    self.light.retrieval = self.retrieval
+                    self.light.vectors = self.vectors
+                ai = self.light
+            else:
+                ai = self
+            hits = ai.memoryHits
+            start = time.perf_counter()
+            results = ai.translateBatch([text for _, text in items])
+            if results is None:
+                if ai is not self:
+                    print(f"{Highlight.RED}小模型翻译失败：{Highlight.RESET}{ai.lastError}")
+                    self.lastError = ai.lastError
+                    self.lastCut = ai.lastCut
+                return None
+            hits = ai.memoryHits - hits
+            router.record(Route.memory, hits, 0)
+            router.record(route, len(items) - hits, time.perf_counter() - start)
+            countTranslated(len(items) - hits)
+            translated.update(
+                {index: result for (index, _), result in zip(items, results)}
+            )
+            for (index, text), result in zip(items, results):
+                logRecord(
+                    {
+                        "file": self.label,
+                        "index": index,
+                        "route": route,
+                        "model": ai.model,
+                        "source": text,
+                        "translation": result,
+                    }
                 )
-                return False  # 强制结束
-            # 取出记录（译文）
-            processed_line = self.getLastMessage()
-            # 限制历史记录
-            self.trim_history()
-            # 写入文件
-            tra_file.write(processed_line)
-            tra_file.write("\n")
+        return translated
+
+    def translateChunk(self, ai, todo: list, translated: dict) -> bool:
+        """翻译一批(序号, 原文)：通过校验的放入translated并记录断点，
+        请求失败或未通过校验的放入重试队列；连续请求失败过多时返回False"""
+        for index, text in todo:
+            detail(f"{Highlight.BLUE}{index + 1}.正在处理：{Highlight.RESET}{text}")
+        result = ai.translateUnits(todo)
+        with self.lock:
+            if result is None:
+                print(f"{Highlight.YELLOW}翻译失败，稍后重试：{Highlight.RESET}{ai.lastError}")
+                if ai.lastCut:
+                    # 服务正常但生成跑偏，和未通过校验一样交给重试，不计入连续请求失败
+                    self.failedRequests = 0
+                    self.queueRetry([(index, text, ai.lastCut) for index, text in todo])
+                    return True
+                self.failedRequests += 1
+                self.queueRetry([(index, text, "请求失败") for index, text in todo])
+                return self.failedRequests < abort_after_failures
+            self.failedRequests = 0
+            passed = {}
+            failed = []
+            for index, text in todo:
+                reason = checkTranslation(text, result[index])
+                if reason:
+                    self.rejected[index] = result[index]
+                    failed.append((index, text, reason))
+                else:
+                    passed[index] = result[index]
+            self.queueRetry(failed)
+            translated.update(passed)
+            # 和翻译记忆一样，只有通过校验的译文进入检索索引
+            self.index([(text, passed[index]) for index, text in todo if index in passed])
+            if self.journal and (passed or ai.newMessages):
+                self.journal.record(passed, ai.newMessages)
+                ai.newMessages = []
         return True
 
+    def queueRetry(self, failed: list):
+        for index, text, reason in failed:
+            detail(f"{Highlight.YELLOW}{index + 1}.放入重试队列（{reason}）：{Highlight.RESET}{text}")
+            self.failureReasons[reason] += 1
+        self.retryQueue.extend(failed)
+
+    def retryAI(self):
+        """校验重试用的备用模型，首次使用时创建"""
+        if self.fallback is None:
+            self.fallback = AI(fallback_model)
+            self.fallback.label = self.label
+            self.fallback.glossary = self.glossary
+            self.fallback.retrieval = self.retrieval
+            self.fallback.vectors = self.vectors
+        return self.fallback
+
+    def retryFailed(self, translated: dict) -> bool:
+        """逐条重试未通过的字幕：先加严提示词，再换备用模型；
+        仍未通过的使用清理后的译文，返回是否每条字幕都有译文"""
+        queue_ = sorted(self.retryQueue)
+        self.retryQueue = []
+        if not queue_:
+            return True
+        print(f"{Highlight.YELLOW}重试未通过的字幕：{Highlight.RESET}{len(queue_)}条")
+        for attempt in range(validation_retries):
+            ai = self if attempt == 0 else self.retryAI()
+            remaining = []
+            for index, text, _ in queue_:
+                result = ai.translateLine(text, retryPrompt_str)
+                if result is None:
+                    reason = ai.lastCut or "请求失败"
+                else:
+                    reason = checkTranslation(text, result)
+                if reason:
+                    if result is not None:
+                        self.rejected[index] = result
+                    remaining.append((index, text, reason))
+                    continue
+                translated[index] = result
+                self.retryFixed += 1
+                self.index([(text, result)])
+                logRecord(
+                    {
+                        "file": self.label,
+                        "index": index,
+                        "route": "retry",
+                        "model": ai.model,
+                        "source": text,
+                        "translation": result,
+                    }
+                )
+                if self.journal:
+                    self.journal.record({index: result}, ai.newMessages)
+                    ai.newMessages = []
+            queue_ = remaining
+            if not queue_:
+                break
+        for index, text, reason in queue_:
+            self.unresolved += 1
+            if index in self.rejected:
+                translated[index] = cleanTranslation(self.rejected[index])
+            print(f"{Highlight.RED}{index + 1}.重试后仍未通过（{reason}）：{Highlight.RESET}{text}")
+        return all(index in translated for index, _, _ in queue_)
+
+    def writeOutput(self, tra_file, parser: TextParser, layout: list, translated: dict):
+        """按原结构写入：(原样写回的行, None) 或 (字幕, 序号)"""
+        for item, index in layout:
+            if index is None:
+                tra_file.write(item)  # 原封不动写入
+            else:
+                parser.write(tra_file, item, translated.get(index))
+
+    @staticmethod
+    def readLayout(ori_file, parser: TextParser):
+        """读入整个文件，返回原结构和全部字幕"""
+        layout = []
+        cues = []
+        for item in parser.parse(ori_file):
+            # 原样保留的行和空字幕
+            if not isinstance(item, Cue) or not item.lines:
+                layout.append((item.header if isinstance(item, Cue) else item, None))
+                continue
+            layout.append((item, len(cues)))
+            cues.append(item)
+        return layout, cues
+
+    def solveOneFile(
+        self, ori_file, tra_file, parser: TextParser = None, batch: int = None
+    ) -> bool:
+        parser = parser or SrtParser()
+        batch = batch_size if batch is None else max(1, batch)
+        # 先读入整个文件，译文全部完成并修补后再按原结构写入
+        layout, cues = self.readLayout(ori_file, parser)
+        texts = [cue.text() for cue in cues]
+        translated = dict(self.journal.units) if self.journal else {}
+        # 检索上下文：批量向量化全部待译原文
+        self.embed([text for index, text in enumerate(texts) if index not in translated])
+        if scene_workers > 1:
+            ok = self.solveScenes(cues, texts, translated, batch)
+        else:
+            todo = [(index, text) for index, text in enumerate(texts) if index not in translated]
+            ok = all(
+                self.translateChunk(self, todo[start : start + batch], translated)
+                for start in range(0, len(todo), batch)
+            )
+        if not ok:
+            print(f"{Highlight.RED}连续{abort_after_failures}次请求失败，放弃该文件{Highlight.RESET}")
+            return False
+        ok = self.retryFailed(translated)
+        self.report(batch)
+        if not ok:
+            return False
+        self.writeOutput(tra_file, parser, layout, translated)
+        return True
+
+    def report(self, batch: int):
+        """文件结束时的术语表、批量翻译和校验统计"""
+        if self.glossary:
+            print(
+                f"{Highlight.BLUE}术语表：{Highlight.RESET}{len(self.glossary)}条，"
+                f"未使用锁定译名{self.glossaryMisses}次"
+            )
+        if batch > 1:
+            print(
+                f"{Highlight.BLUE}批量翻译：{Highlight.RESET}{self.batchedLines}条，"
+                f"{Highlight.BLUE}逐条回退：{Highlight.RESET}{self.fallbackLines}条"
+            )
+        if engine == "generate" and self.rebases:
+            print(f"{Highlight.BLUE}续写context：{Highlight.RESET}重新建立{self.rebases}次")
+        if self.failureReasons:
+            reasons = "，".join(f"{r}{n}条" for r, n in self.failureReasons.most_common())
+            print(
+                f"{Highlight.BLUE}校验：{Highlight.RESET}未通过{sum(self.failureReasons.values())}条"
+                f"（{reasons}），重试修复{self.retryFixed}条，仍未通过{self.unresolved}条"
+            )
+
+    def sceneAI(self):
+        """为一个场景创建独立上下文的AI，沿用本文件的设置"""
+        ai = AI(self.model)
+        ai.label = self.label
+        ai.glossary = self.glossary
+        ai.retrieval = self.retrieval
+        ai.vectors = self.vectors
+        return ai
+
+    def translateScene(self, scene, overlap, texts, done, translated, batch, stop, buffered):
+        """翻译一个场景中未完成的字幕并放入translated，返回是否完成和本场景的输出"""
+        if buffered:
+            thread_output.buffer = []
+        ai = self.sceneAI()
+        try:
+            # 用前一场景末尾的几条建立上下文：已有译文时直接放入历史，否则先译一遍，结果不采用
+            # 失败的轮次已由translateBatch/translateLine移出历史，这里不用再处理，直接不带重叠上下文继续
+            if overlap and all(index in done for index in overlap):
+                for index in overlap:
+                    ai.addMess(Message(Role.user, texts[index]))
+                    ai.addMess(Message(Role.ai, done[index]))
+                ai.trim_history()
+            elif overlap:
+                ai.translateBatch([texts[index] for index in overlap])
+            todo = [(index, texts[index]) for index in scene if index not in done]
+            for start in range(0, len(todo), batch):
+                if stop.is_set():
+                    return False, self.sceneOutput(buffered)
+                if not self.translateChunk(ai, todo[start : start + batch], translated):
+                    stop.set()
+                    return False, self.sceneOutput(buffered)
+            return True, self.sceneOutput(buffered)
+        finally:
+            ai.close()
+            with self.lock:
+                self.memoryHits += ai.memoryHits
+                self.rebases += ai.rebases
+                self.batchedLines += ai.batchedLines
+                self.fallbackLines += ai.fallbackLines
+                self.glossaryMisses += ai.glossaryMisses
+
+    @staticmethod
+    def sceneOutput(buffered: bool):
+        if not buffered:
+            return []
+        output = thread_output.buffer
+        thread_output.buffer = None
+        return output
+
+    def solveScenes(self, cues: list, texts: list, translated: dict, batch: int) -> bool:
+        """场景并行：整个文件切成若干场景同时翻译，译文放入translated"""
+        done = dict(translated)
+        scenes = splitScenes(cues)
+        print(
+            f"{Highlight.BLUE}场景并行：{Highlight.RESET}{len(cues)}条字幕分为{len(scenes)}个场景，"
+            f"{min(scene_workers, len(scenes))}路并发"
+        )
+        # 并发翻译文件时，本文件的输出先攒在缓冲里，各场景的输出按顺序并入
+        parent_buffer = getattr(thread_output, "buffer", None)
+        buffered = parent_buffer is not None
+        stop = threading.Event()
+        ok = True
+        with ThreadPoolExecutor(max_workers=scene_workers) as executor:
+            futures = [
+                executor.submit(
+                    self.translateScene,
+                    scene,
+                    scenes[number - 1][-scene_overlap:] if number and scene_overlap else [],
+                    texts,
+                    done,
+                    translated,
+                    batch,
+                    stop,
+                    buffered,
+                )
+                for number, scene in enumerate(scenes)
+            ]
+            for future in futures:
+                try:
+                    finished, output = future.result()
+                except Exception as e:
+                    stop.set()
+                    print(f"{Highlight.RED}场景翻译出错：{Highlight.RESET}{str(e)}")
+                    ok = False
+                    continue
+                if buffered:
+                    parent_buffer.extend(output)
+                ok = ok and finished
+        return ok
+
+
+def checkTranslation(source: str, translation: str) -> str:
+    """快速校验一条译文，返回未通过的原因，通过时返回空字符串"""
+    if not use_validation:
+        return ""
+    if not translation.strip():
+        return "译文为空"
+    if THINK_PATTERN.search(translation):
+        return "含思考过程"
+    if EXPLANATION_PATTERN.search(translation):
+        return "含解释性文字"
+    if len(KANA_RESIDUE_PATTERN.findall(translation)) > validation_kana_max:
+        return "残留假名"
+    source_length = len(source.strip())
+    if source_length >= validation_min_length:
+        ratio = len(translation.strip()) / source_length
+        if not validation_min_ratio <= ratio <= validation_max_ratio:
+            return "长度比例异常"
+    return ""
+
+
+def cleanTranslation(translation: str) -> str:
+    """重试后仍未通过时尽量清理：去掉思考过程和解释性的行"""
+    translation = THINK_PATTERN.sub("", translation).strip()
+    lines = [line for line in translation.splitlines() if not EXPLANATION_PATTERN.match(line)]
+    return "\n".join(lines) if lines else translation
+
+
+def parseCueTime(value):
+    """字幕时间转为秒，无法识别时返回None"""
+    match = CUE_TIME_PATTERN.match(value or "")
+    if not match:
+        return None
+    hours, minutes, seconds, fraction = match.groups()
+    return (
+        int(hours or 0) * 3600
+        + int(minutes) * 60
+        + int(seconds)
+        + int(fraction) / 10 ** len(fraction)
+    )
+
+
+def splitScenes(cues: list) -> list:
+    """按相邻字幕的时间间隔切分场景，场景过长时按条数切开，返回各场景的字幕序号列表"""
+    scenes = []
+    scene = []
+    last_end = None
+    for index, cue in enumerate(cues):
+        start = parseCueTime(cue.start)
+        gap = (
+            start - last_end if start is not None and last_end is not None else 0
+        )
+        if scene and (
+            len(scene) >= scene_max_cues
+            or (gap >= scene_gap_seconds and len(scene) >= scene_min_cues)
+        ):
+            scenes.append(scene)
+            scene = []
+        scene.append(index)
+        end = parseCueTime(cue.end)
+        if end is not None:
+            last_end = end
+    if scene:
+        scenes.append(scene)
+    return scenes
+
 
 def Test_solveOneFile(ori_file, tra_file) -> bool:
     for line in ori_file:
@@ -206,34 +2493,155 @@ def Test_solveOneFile(ori_file, tra_file) -> bool:
 
 
 def branch_thread_task():
+    """定时输出运行时间和吞吐汇总"""
     secondCount = 0
     while running_tag:
-        # print(".", end="")
         time.sleep(1)
         secondCount = secondCount + 1
-        if not secondCount % 5:
-            print(f"{Highlight.RED}运行时间：{secondCount}秒{Highlight.RESET}")
+        if not secondCount % report_interval:
+            summary = metrics.run.summary()
+            print(
+                f"{Highlight.RED}运行时间：{secondCount}秒{Highlight.RESET}，"
+                f"已翻译{translated_cues}条，{summary['requests']}次请求，"
+                f"生成{summary['eval_tokens_per_sec']}token/秒，"
+                f"延迟p95 {summary['latency_p95']}秒"
+            )
     print(
         f"{Highlight.GREEN}{Highlight.BOLD}{Highlight.UNDERLINE}总运行时间：{secondCount}秒\n{Highlight.RESET}"
     )
 
 
 class Logger(object):
-    def __init__(self, filename="Default.log", path="./"):
+    """替换sys.stdout：print只放入队列，由后台线程批量写入终端和日志文件。
+    日志文件去掉颜色，按日期和大小轮转；逐行翻译另写一份结构化JSONL记录"""
+
+    def __init__(self, filename="Default.log", path="./", level: int = None):
         # 保存原始的stdout，以便继续输出到终端
         self.terminal = sys.stdout
+        self.path = path
+        self.level = console_level if level is None else level
+        self.queue = queue.SimpleQueue()
+        self.date = datetime.date.today()
         # 以追加模式('a')打开日志文件，utf-8-nobom编码
         self.log = open(os.path.join(path, filename), "a", encoding="utf8")
-
-    def write(self, message):
-        # 将消息同时写入终端和文件
-        self.terminal.write(message)
-        self.log.write(message)
+        self.records = None
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    def write(self, message, level: int = LEVEL_INFO):
+        # 并发任务的输出先写入缓冲
+        buffer = getattr(thread_output, "buffer", None)
+        if buffer is not None:
+            buffer.append((level, message))
+            return
+        self.queue.put((level, message))
+
+    def emit(self, entries: list):
+        """按顺序写入一组(级别, 内容)，用于并发任务攒下的输出"""
+        for entry in entries:
+            self.queue.put(entry)
+
+    def record(self, record: dict):
+        """结构化的逐行记录"""
+        self.queue.put((None, record))
 
     def flush(self):
-        # 为了保证实时写入，每次write后都清空缓冲区
-        self.log.flush()
-        self.terminal.flush()
+        # 由后台线程统一刷新，这里不阻塞调用方
+        pass
+
+    def run(self):
+        while True:
+            entries = [self.queue.get()]
+            # 一次取出队列中已有的内容合并写入
+            while len(entries) < log_batch_size:
+                try:
+                    entries.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            # close()之后仍可能有迟到的输出排在结束标记后面，只要本批含结束标记就退出
+            stop = None in entries
+            self.writeBatch([e for e in entries if e is not None])
+            if stop:
+                return
+
+    def writeBatch(self, entries: list):
+        self.rotate()
+        terminal = []
+        text = []
+        records = []
+        for level, message in entries:
+            if level is None:
+                records.append(json.dumps(message, ensure_ascii=False) + "\n")
+                continue
+            text.append(message)
+            if level <= self.level:
+                terminal.append(message)
+        if terminal:
+            self.terminal.write("".join(terminal))
+            self.terminal.flush()
+        if text:
+            self.log.write(ANSI_PATTERN.sub("", "".join(text)))
+            self.log.flush()
+        if records:
+            if self.records is None:
+                self.records = open(self.recordPath(), "a", encoding="utf8")
+            self.records.write("".join(records))
+            self.records.flush()
+
+    def recordPath(self) -> str:
+        return os.path.join(self.path, f"{self.date.strftime("%Y-%m-%d")}.jsonl")
+
+    def rotate(self):
+        """跨日时换新文件，超出大小时把当前文件改名为 .1 .2 ..."""
+        today = datetime.date.today()
+        if today != self.date:
+            self.date = today
+            self.reopen(f"{today.strftime("%Y-%m-%d")}.log")
+            if self.records:
+                self.records.close()
+                self.records = None
+            return
+        if self.log.tell() < log_max_bytes:
+            return
+        current = self.log.name
+        self.log.close()
+        number = 1
+        while os.path.exists(f"{current}.{number}"):
+            number += 1
+        os.replace(current, f"{current}.{number}")
+        self.log = open(current, "a", encoding="utf8")
+
+    def reopen(self, filename: str):
+        self.log.close()
+        self.log = open(os.path.join(self.path, filename), "a", encoding="utf8")
+
+    def close(self):
+        """写完队列中剩余的内容再关闭"""
+        self.queue.put(None)
+        self.writer.join()
+        self.log.close()
+        if self.records:
+            self.records.close()
+
+
+def detail(message: str):
+    """逐行详情：总会写入日志文件，终端按console_level决定是否显示"""
+    if isinstance(sys.stdout, Logger):
+        sys.stdout.write(message + "\n", LEVEL_DETAIL)
+    elif console_level >= LEVEL_DETAIL:
+        print(message)
+
+
+def logRecord(record: dict):
+    if isinstance(sys.stdout, Logger):
+        sys.stdout.record(record)
+
+
+def emitOutput(entries: list):
+    if isinstance(sys.stdout, Logger):
+        sys.stdout.emit(entries)
+    else:
+        sys.stdout.write("".join(message for _, message in entries))
 
 
 # 定义 ANSI 转义序列常量
@@ -274,6 +2682,7 @@ def initFolder():
     creatFolder(origin_folder)
     creatFolder(translate_folder)
     creatFolder(log_folder)
+    creatFolder(cache_folder)
 
 
 def getRelativePath(filepath: str, base_folder: str) -> str:
@@ -302,11 +2711,671 @@ def process_file(origin_file_path: str, translate_folder: str):
     return translate_file_path
 
 
+def solveFile(origin_file_path: str) -> bool:
+    """翻译单个文件，返回是否成功"""
+    filename = os.path.basename(origin_file_path)
+    # 生成目标文件路径，先写临时文件，完成后再替换
+    translate_file_path = process_file(origin_file_path, translate_folder)
+    temp_file_path = translate_file_path + ".tmp"
+
+    journal = None
+    ai = None
+    try:
+        if use_journal:
+            journal = Journal(journalPath(origin_file_path), hashFile(origin_file_path))
+            # 原文未变且已译完的文件直接跳过
+            if journal.done and os.path.exists(translate_file_path):
+                print(
+                    f"{Highlight.GREEN}已完成，跳过：{Highlight.RESET}{filename}"
+                )
+                return True
+            journal.done = False
+            journal.open()
+
+        # 开始读写文件
+        with open(
+            origin_file_path, "r", encoding="utf-8-sig"  # 兼容NOBOM/BOM
+        ) as ori_file, open(temp_file_path, "w", encoding="utf-8") as tra_file:
+
+            # 创建新AI，每个文件独立的对话记录
+            ai = AI()
+            ai.label = getRelativePath(origin_file_path, origin_folder)
+            ai.glossary = loadGlossary(origin_file_path)
+            ai.retrieval = loadRetrieval(origin_file_path)
+            # 开始处理
+            print(
+                f"{Highlight.YELLOW}{Highlight.BOLD}\n开始处理文件：{Highlight.RESET}{filename}"
+            )
+            if journal:
+                if journal.units:
+                    print(
+                        f"{Highlight.YELLOW}断点续翻：{Highlight.RESET}已完成{len(journal.units)}行"
+                    )
+                ai.resume(journal)
+            ok = ai.solveOneFile(ori_file, tra_file, getParser(origin_file_path))
+        if not ok:
+            os.remove(temp_file_path)
+            print(
+                f"{Highlight.RED}{Highlight.BOLD}\n文件处理失败：{Highlight.RESET}{filename}"
+            )
+            return False
+        # 原子替换，避免留下写了一半的译文
+        os.replace(temp_file_path, translate_file_path)
+        if journal:
+            journal.finish()
+        print(
+            f"{Highlight.GREEN}{Highlight.BOLD}\n文件处理完成：{Highlight.RESET}{filename}"
+        )
+        return True
+    except Exception as e:
+        print(f"处理文件 {filename} 时出错: {str(e)}")
+        return False
+    finally:
+        if journal:
+            journal.close()
+        if ai:
+            ai.close()
+            metrics.finishFile(ai.label)
+            if ai.retrieval is not None:
+                ai.retrieval.save()
+
+
+def collectFiles() -> list:
+    """使用 os.walk 递归收集原文件夹中的全部文件"""
+    file_list = []
+    for root, dirs, files in os.walk(origin_folder):
+        for filename in files:
+            # 术语表不是待翻译的字幕
+            if filename == glossary_name:
+                continue
+            file_list.append(os.path.join(root, filename))
+    return file_list
+
+
+def bufferedSolveFile(origin_file_path: str):
+    """并发模式下的任务：输出写入线程缓冲，返回(是否成功, [(级别, 内容)])"""
+    thread_output.buffer = []
+    try:
+        ok = solveFile(origin_file_path)
+    except Exception as e:
+        # 单个文件的异常不影响其他文件
+        print(f"处理文件 {origin_file_path} 时出错: {str(e)}")
+        ok = False
+    finally:
+        output = thread_output.buffer
+        thread_output.buffer = None
+    return ok, output
+
+
+def runScheduler(file_list: list, workers: int = None) -> list:
+    """调度全部文件，workers大于1时并发翻译，返回失败的文件列表"""
+    workers = max_workers if workers is None else workers
+    failed = []
+    if workers <= 1:
+        for origin_file_path in file_list:
+            if not solveFile(origin_file_path):
+                failed.append(origin_file_path)
+        return failed
+
+    print(f"{Highlight.BLUE}并发翻译：{Highlight.RESET}{workers}个文件同时处理")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(bufferedSolveFile, f) for f in file_list]
+        # 按提交顺序输出，保证每个文件的日志连续
+        for origin_file_path, future in zip(file_list, futures):
+            ok, output = future.result()
+            emitOutput(output)
+            if not ok:
+                failed.append(origin_file_path)
+    if failed:
+        print(f"{Highlight.RED}失败文件数：{Highlight.RESET}{len(failed)}")
+    return failed
+
+
+def normalizeLine(text: str) -> str:
+    """规范化原文用于查重：全半角统一，去掉首尾和多余空白"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def countTranslated(count: int):
+    global translated_cues
+    with stats_lock:
+        translated_cues += count
+
+
+class Plan:
+    """预扫描结果：每个文件的字幕数、重复短句索引和耗时估算"""
+
+    def __init__(self):
+        # 每个文件：[路径, 字幕数, 原文token数, 是否已完成]
+        self.files = []
+        # 规范化原文 -> 出现次数
+        self.frequency = Counter()
+
+    def duplicates(self) -> list:
+        """需要统一翻译的重复短句，按出现次数从多到少"""
+        return [
+            (text, count)
+            for text, count in self.frequency.most_common()
+            if count >= duplicate_min_count and len(text) <= duplicate_max_length
+        ]
+
+    def estimate(self) -> dict:
+        todo = [f for f in self.files if not f[3]]
+        cues = sum(f[1] for f in todo)
+        source_tokens = sum(f[2] for f in todo)
+        duplicates = self.duplicates()
+        # 重复短句只翻译一次，其余出现都省掉
+        saved = sum(count - 1 for _, count in duplicates) if use_plan else 0
+        requests_count = -(-max(0, cues - saved) // max(1, batch_size))
+        lines_per_second = loadThroughput() or default_lines_per_second
+        return {
+            "files": len(todo),
+            "skipped": len(self.files) - len(todo),
+            "cues": cues,
+            "duplicates": len(duplicates),
+            "saved": saved,
+            "requests": requests_count,
+            # 稳定后每次请求的提示词约等于上下文预算
+            "prompt_tokens": requests_count * int(num_ctx * context_budget_ratio),
+            "output_tokens": source_tokens,
+            "seconds": (cues - saved) / lines_per_second,
+            "lines_per_second": lines_per_second,
+        }
+
+    def report(self, top: int = 10):
+        for path, cues, tokens, done in self.files:
+            state = "已完成" if done else f"{cues}条，约{tokens}token"
+            print(f"  {getRelativePath(path, origin_folder)}：{state}")
+        estimate = self.estimate()
+        print(
+            f"{Highlight.BLUE}待翻译：{Highlight.RESET}{estimate['files']}个文件"
+            f"（跳过{estimate['skipped']}个），{estimate['cues']}条字幕\n"
+            f"{Highlight.BLUE}重复短句：{Highlight.RESET}{estimate['duplicates']}句，"
+            f"统一翻译可省{estimate['saved']}次翻译\n"
+            f"{Highlight.BLUE}预计请求：{Highlight.RESET}{estimate['requests']}次，"
+            f"提示词约{estimate['prompt_tokens']}token，输出约{estimate['output_tokens']}token\n"
+            f"{Highlight.BLUE}预计耗时：{Highlight.RESET}{estimate['seconds'] / 60:.1f}分钟"
+            f"（按{estimate['lines_per_second']:.2f}条/秒）"
+        )
+        for text, count in self.duplicates()[:top]:
+            print(f"  {count}次：{text}")
+
+
+def buildPlan(file_list: list) -> Plan:
+    """扫描全部文件，统计字幕数和重复短句"""
+    plan = Plan()
+    for origin_file_path in file_list:
+        translate_file_path = process_file(origin_file_path, translate_folder)
+        done = False
+        if use_journal:
+            journal = Journal(journalPath(origin_file_path), hashFile(origin_file_path))
+            done = journal.done and os.path.exists(translate_file_path)
+        cues = 0
+        tokens = 0
+        parser = getParser(origin_file_path)
+        try:
+            with open(origin_file_path, "r", encoding="utf-8-sig") as ori_file:
+                for item in parser.parse(ori_file):
+                    if not isinstance(item, Cue) or not item.lines:
+                        continue
+                    cues += 1
+                    tokens += estimateTokens(item.text())
+                    if not done:
+                        plan.frequency[normalizeLine(item.text())] += 1
+        except (UnicodeDecodeError, OSError) as e:
+            print(f"扫描文件 {origin_file_path} 时出错: {str(e)}")
+            continue
+        plan.files.append([origin_file_path, cues, tokens, done])
+    return plan
+
+
+def preTranslate(plan: Plan):
+    """统一翻译重复短句，结果供所有文件直接使用"""
+    texts = [text for text, _ in plan.duplicates() if text not in shared_translations]
+    if not texts:
+        return
+    print(f"{Highlight.YELLOW}统一翻译重复短句：{Highlight.RESET}{len(texts)}句")
+    ai = AI()
+    step = max(1, batch_size)
+    for start in range(0, len(texts), step):
+        chunk = texts[start : start + step]
+        results = ai.translateBatch(chunk)
+        if results is None:
+            # 失败的短句留给各文件按上下文翻译
+            print(f"{Highlight.RED}翻译失败：{Highlight.RESET}{ai.lastError}")
+            continue
+        # 未通过校验的短句同样留给各文件
+        shared_translations.update(
+            (text, result)
+            for text, result in zip(chunk, results)
+            if not checkTranslation(text, result)
+        )
+    ai.close()
+
+
+def loadThroughput() -> float:
+    path = os.path.join(cache_folder, throughput_file)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("lines_per_second", 0)
+    except (OSError, json.JSONDecodeError):
+        return 0
+
+
+def saveThroughput(cues: int, seconds: float):
+    """记录本次实测吞吐，供下次估算耗时"""
+    if cues <= 0 or seconds <= 0:
+        return
+    with open(os.path.join(cache_folder, throughput_file), "w", encoding="utf-8") as f:
+        json.dump({"lines_per_second": cues / seconds}, f)
+
+
+class JobQueue:
+    """守护模式的持久化任务队列（SQLite），按优先级从高到低、入队时间从早到晚取出"""
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        # 有新任务时唤醒等待的工作线程
+        self.ready = threading.Condition(self.lock)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "path TEXT PRIMARY KEY, state TEXT NOT NULL, priority INTEGER NOT NULL, "
+            "mtime REAL NOT NULL, size INTEGER NOT NULL, attempts INTEGER NOT NULL, "
+            "enqueued REAL NOT NULL, not_before REAL NOT NULL, "
+            "started REAL, finished REAL, dirty INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_order ON jobs(state, priority, enqueued)"
+        )
+        self.conn.commit()
+
+    def recover(self) -> int:
+        """上次退出时仍在处理的任务重新排队，断点记录保证不会重复翻译"""
+        with self.lock:
+            count = self.conn.execute(
+                "UPDATE jobs SET state='queued', dirty=0 WHERE state='running'"
+            ).rowcount
+            self.conn.commit()
+        return count
+
+    def signatures(self) -> dict:
+        """每个已知文件最近一次入队时的(修改时间, 大小)"""
+        with self.lock:
+            rows = self.conn.execute("SELECT path, mtime, size FROM jobs").fetchall()
+        return {path: (mtime, size) for path, mtime, size in rows}
+
+    def enqueue(self, path: str, mtime: float, size: int, priority: int):
+        """新文件入队；已有的任务更新为最新版本并重新排队，优先级取较高者。
+        正在处理的任务保持处理中，只标记dirty，由finish()在处理结束后重新排队"""
+        now = time.time()
+        with self.ready:
+            self.conn.execute(
+                "INSERT INTO jobs (path, state, priority, mtime, size, attempts, enqueued, not_before) "
+                "VALUES (?, 'queued', ?, ?, ?, 0, ?, 0) "
+                "ON CONFLICT(path) DO UPDATE SET "
+                "dirty=CASE WHEN jobs.state='running' THEN 1 ELSE 0 END, "
+                "state=CASE WHEN jobs.state='running' THEN 'running' ELSE 'queued' END, "
+                "priority=MAX(excluded.priority, CASE WHEN jobs.state='queued' THEN jobs.priority ELSE excluded.priority END), "
+                "mtime=excluded.mtime, size=excluded.size, attempts=0, "
+                "enqueued=excluded.enqueued, not_before=0",
+                (path, priority, mtime, size, now),
+            )
+            self.conn.commit()
+            self.ready.notify()
+
+    def take(self, timeout: float):
+        """取出下一个可执行的任务并标记为处理中，超时没有任务时返回None"""
+        deadline = time.time() + timeout
+        with self.ready:
+            while True:
+                now = time.time()
+                row = self.conn.execute(
+                    "SELECT path FROM jobs WHERE state='queued' AND not_before<=? "
+                    "ORDER BY priority DESC, enqueued LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row:
+                    self.conn.execute(
+                        "UPDATE jobs SET state='running', started=? WHERE path=?",
+                        (now, row[0]),
+                    )
+                    self.conn.commit()
+                    return row[0]
+                if now >= deadline:
+                    return None
+                self.ready.wait(deadline - now)
+
+    def finish(self, path: str, ok: bool):
+        """结束处理；处理中被修改过的文件不论结果都按新版本重新排队"""
+        now = time.time()
+        with self.ready:
+            requeued = self.conn.execute(
+                "UPDATE jobs SET state='queued', dirty=0, finished=? "
+                "WHERE path=? AND state='running' AND dirty=1",
+                (now, path),
+            ).rowcount
+            if requeued:
+                self.conn.commit()
+                self.ready.notify()
+                return
+            if ok:
+                self.conn.execute(
+                    "UPDATE jobs SET state='done', finished=? WHERE path=? AND state='running'",
+                    (now, path),
+                )
+            else:
+                # 失败的任务降低优先级，按次数退避后重试，超出次数后放弃
+                self.conn.execute(
+                    "UPDATE jobs SET attempts=attempts+1, finished=?, priority=?, "
+                    "state=CASE WHEN attempts+1>=? THEN 'failed' ELSE 'queued' END, "
+                    "not_before=?+?*(attempts+1) WHERE path=? AND state='running'",
+                    (now, PRIORITY_RETRY, job_max_attempts, now, job_retry_delay, path),
+                )
+            self.conn.commit()
+
+    def remove(self, path: str):
+        with self.lock:
+            self.conn.execute("DELETE FROM jobs WHERE path=?", (path,))
+            self.conn.commit()
+
+    def counts(self) -> dict:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT state, COUNT(*) FROM jobs GROUP BY state"
+            ).fetchall()
+        counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+        counts.update(dict(rows))
+        return counts
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# 任务优先级：运行中新出现或被修改的文件最先处理，启动时的存量其次，失败重试最后
+PRIORITY_NEW = 10
+PRIORITY_BACKLOG = 0
+PRIORITY_RETRY = -10
+
+
+class FolderWatcher:
+    """监视原文件夹：有watchdog时用文件系统事件（Linux下为inotify）及时唤醒，
+    否则按间隔轮询；文件大小和修改时间稳定一段时间后才入队，避免读到上传了一半的文件"""
+
+    def __init__(self, jobs: JobQueue):
+        self.jobs = jobs
+        # 已入队的版本：路径 -> (修改时间, 大小)
+        self.known = jobs.signatures()
+        # 等待稳定的文件：路径 -> ((修改时间, 大小), 首次看到该版本的时间)
+        self.settling = {}
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.observer = None
+        self.thread = None
+        self.first = True
+
+    def start(self):
+        if Observer is not None:
+            watcher = self
+
+            class Handler(FileSystemEventHandler):
+                def on_any_event(self, event):
+                    watcher.wake.set()
+
+            self.observer = Observer()
+            self.observer.schedule(Handler(), origin_folder, recursive=True)
+            self.observer.start()
+            print(f"{Highlight.BLUE}监视文件夹：{Highlight.RESET}文件系统事件")
+        else:
+            print(
+                f"{Highlight.BLUE}监视文件夹：{Highlight.RESET}未安装watchdog，每{watch_interval}秒轮询"
+            )
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.scan()
+            except OSError as e:
+                print(f"{Highlight.RED}扫描原文件夹出错：{Highlight.RESET}{str(e)}")
+            # 有文件等待稳定时按稳定时间再看一次
+            timeout = watch_settle_seconds if self.settling else watch_interval
+            self.wake.wait(timeout)
+            self.wake.clear()
+
+    def scan(self):
+        now = time.time()
+        current = set()
+        for path in collectFiles():
+            # 跳过隐藏文件和上传工具的临时文件
+            if os.path.basename(path).startswith("."):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # 扫描期间被删除
+            current.add(path)
+            signature = (stat.st_mtime, stat.st_size)
+            if self.known.get(path) == signature:
+                self.settling.pop(path, None)
+                continue
+            seen = self.settling.get(path)
+            if seen is None or seen[0] != signature:
+                self.settling[path] = (signature, now)
+                # 启动时已存在的文件无需等待
+                if not self.first:
+                    continue
+            elif now - seen[1] < watch_settle_seconds:
+                continue
+            self.settling.pop(path, None)
+            priority = PRIORITY_BACKLOG if self.first else PRIORITY_NEW
+            self.jobs.enqueue(path, *signature, priority)
+            self.known[path] = signature
+            print(f"{Highlight.BLUE}加入队列：{Highlight.RESET}{getRelativePath(path, origin_folder)}")
+        for path in list(self.settling):
+            if path not in current:
+                del self.settling[path]
+        self.first = False
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+        if self.observer:
+            self.observer.stop()
+            self.observer.join()
+        if self.thread:
+            self.thread.join()
+
+
+class DaemonStatus:
+    """守护模式的状态：写入metrics.gauges供 /metrics 导出，并定期写入状态文件"""
+
+    def __init__(self, jobs: JobQueue):
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.running = {}
+        self.done = 0
+        self.failed = 0
+        # 处理文件的累计耗时，用于计算吞吐
+        self.busySeconds = 0.0
+        self.lastJob = None
+        # 最近一次处理文件或确认模型常驻的时间
+        self.lastActive = time.time()
+
+    def begin(self, path: str):
+        with self.lock:
+            self.running[path] = time.time()
+
+    def end(self, path: str, ok: bool):
+        with self.lock:
+            seconds = time.time() - self.running.pop(path)
+            self.busySeconds += seconds
+            self.lastActive = time.time()
+            if ok:
+                self.done += 1
+            else:
+                self.failed += 1
+            self.lastJob = {
+                "file": getRelativePath(path, origin_folder),
+                "ok": ok,
+                "seconds": round(seconds, 1),
+                "finished": datetime.datetime.now().isoformat(timespec="seconds"),
+            }
+
+    def dueWarm(self) -> bool:
+        """全部空闲超过warm_interval时返回True，由一个工作线程去确认模型常驻"""
+        with self.lock:
+            if self.running or time.time() - self.lastActive < warm_interval:
+                return False
+            self.lastActive = time.time()
+            return True
+
+    def snapshot(self) -> dict:
+        counts = self.jobs.counts()
+        with self.lock:
+            busy = self.busySeconds + sum(time.time() - t for t in self.running.values())
+            status = {
+                "time": datetime.datetime.now().isoformat(timespec="seconds"),
+                "uptime_seconds": round(time.time() - self.started),
+                "queue_depth": counts["queued"],
+                "running": [getRelativePath(p, origin_folder) for p in self.running],
+                "jobs": counts,
+                "done_this_run": self.done,
+                "failed_this_run": self.failed,
+                "cues_translated": translated_cues,
+                "cues_per_minute": round(translated_cues / busy * 60, 1) if busy else 0,
+                "last_job": self.lastJob,
+            }
+        return status
+
+    def publish(self):
+        status = self.snapshot()
+        metrics.gauges.update(
+            {
+                "queue_depth": status["queue_depth"],
+                "jobs_running": len(status["running"]),
+                "jobs_done": status["done_this_run"],
+                "jobs_failed": status["failed_this_run"],
+                "cues_per_minute": status["cues_per_minute"],
+            }
+        )
+        # 原子替换，外部读取时不会读到写了一半的文件
+        path = os.path.join(log_folder, status_file)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(status, f, ensure_ascii=False, indent=2)
+        os.replace(path + ".tmp", path)
+
+
+def daemonWorker(jobs: JobQueue, status: DaemonStatus, stop: threading.Event, buffered: bool):
+    """工作线程：不断取出任务翻译，空闲时定期确认模型仍在内存中"""
+    while not stop.is_set():
+        path = jobs.take(timeout=1.0)
+        if path is None:
+            if preload_models and status.dueWarm():
+                model_manager.preload()
+            continue
+        if not os.path.exists(path):
+            jobs.remove(path)
+            continue
+        status.begin(path)
+        ok = False
+        try:
+            if buffered:
+                ok, output = bufferedSolveFile(path)
+                emitOutput(output)
+            else:
+                ok = solveFile(path)
+        finally:
+            jobs.finish(path, ok)
+            status.end(path, ok)
+            status.publish()
+
+
+def runDaemon(workers: int = None):
+    """守护模式：监视原文件夹，按优先级翻译队列中的文件，直到Ctrl+C或SIGTERM"""
+    workers = max_workers if workers is None else max(1, workers)
+    jobs = JobQueue(os.path.join(cache_folder, queue_file))
+    recovered = jobs.recover()
+    if recovered:
+        print(f"{Highlight.YELLOW}恢复上次未完成的任务：{Highlight.RESET}{recovered}个")
+    status = DaemonStatus(jobs)
+    watcher = FolderWatcher(jobs)
+    watcher.start()
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=daemonWorker, args=(jobs, status, stop, workers > 1))
+        for _ in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    print(f"{Highlight.GREEN}{Highlight.BOLD}守护模式已启动：{Highlight.RESET}{workers}个工作线程")
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        while True:
+            status.publish()
+            time.sleep(status_interval)
+    except KeyboardInterrupt:
+        print(f"{Highlight.YELLOW}正在退出，等待当前文件完成{Highlight.RESET}")
+    finally:
+        stop.set()
+        watcher.stop()
+        for thread in threads:
+            thread.join()
+        status.publish()
+        jobs.close()
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="400翻译器：用本地Ollama翻译ACG字幕")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="只扫描并打印翻译计划，不调用模型"
+    )
+    parser.add_argument(
+        "--console-level",
+        type=int,
+        choices=[0, 1, 2],
+        help="终端输出：0不输出，1只输出进度和汇总，2输出逐行详情",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="守护模式：常驻监视原文件夹，新文件自动排队翻译",
+    )
+    parser.add_argument(
+        "--scene-workers",
+        type=int,
+        help="单个文件内同时翻译的场景数，1为关闭",
+    )
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
+    args = parseArgs()
     # 开始运行
     running_tag = True
     # 文件夹初始化
     initFolder()
+    # 预扫描，守护模式由任务队列调度
+    file_list = [] if args.daemon else collectFiles()
+    plan = buildPlan(file_list)
+    if args.dry_run:
+        print(f"{Highlight.GREEN}{Highlight.BOLD}翻译计划（未调用模型）：{Highlight.RESET}")
+        plan.report()
+        sys.exit(0)
+    if args.console_level is not None:
+        console_level = args.console_level
+    if args.scene_workers is not None:
+        scene_workers = max(1, args.scene_workers)
+    if use_retrieval and np is None:
+        print(f"{Highlight.YELLOW}未安装numpy，检索上下文已关闭{Highlight.RESET}")
     # 重定向输出到Log和终端
     sys.stdout = Logger(log_file, log_folder)
     print(
@@ -317,46 +3386,48 @@ if __name__ == "__main__":
     branch_thread = threading.Thread(target=branch_thread_task)
     branch_thread.start()
 
-    # 主逻辑
-    # 使用 os.walk 递归遍历原文件夹
-    for root, dirs, files in os.walk(origin_folder):
-        for filename in files:
-            # 原文件的完整路径
-            origin_file_path = os.path.join(root, filename)
-            # 生成目标文件路径
-            translate_file_path = process_file(origin_file_path, translate_folder)
+    # 翻译记忆
+    openMemory()
+    # 运行指标
+    metrics.open(os.path.join(log_folder, metrics_file))
+    if metrics_port:
+        metrics.serve(metrics_port)
 
-            # 开始读写文件
-            try:
-                with open(
-                    origin_file_path, "r", encoding="utf-8-sig"  # 兼容NOBOM/BOM
-                ) as ori_file, open(
-                    translate_file_path, "w", encoding="utf-8"
-                ) as tra_file:
-
-                    # 创建新AI
-                    ai = AI()
-                    # 开始处理
-                    print(
-                        f"{Highlight.YELLOW}{Highlight.BOLD}\n开始处理文件：{Highlight.RESET}{filename}"
-                    )
-                    if not ai.solveOneFile(ori_file, tra_file):
-                        print(
-                            f"{Highlight.RED}{Highlight.BOLD}\n文件处理失败：{Highlight.RESET}{filename}"
-                        )
-                        continue  # 处理下一个文件
-                    print(
-                        f"{Highlight.GREEN}{Highlight.BOLD}\n文件处理完成：{Highlight.RESET}{filename}"
-                    )
-            except Exception as e:
-                print(f"处理文件 {filename} 时出错: {str(e)}")
-                continue
+    # 预加载模型，避免首个请求等待加载
+    if preload_models:
+        model_manager.preload()
+
+    # 主逻辑
+    if args.daemon:
+        runDaemon()
+    else:
+        plan.report()
+        start_time = time.perf_counter()
+        if use_plan:
+            preTranslate(plan)
+        runScheduler(file_list)
+        saveThroughput(translated_cues, time.perf_counter() - start_time)
+    router.report()
+    if unload_at_exit:
+        model_manager.unload()
+    metrics.finishRun()
+    metrics.close()
+    if translation_memory:
+        translation_memory.report()
+        translation_memory.close()
+    getPool().stop()
+    getTransport().close()
 
     # 运行结束，全部文件处理完毕
     running_tag = False
     print(
         f"{Highlight.GREEN}{Highlight.BOLD}{Highlight.UNDERLINE}\n运行结束！\n全部文件处理完毕！{Highlight.RESET}"
     )
+    branch_thread.join()
+    # 写完剩余日志
+    logger = sys.stdout
+    sys.stdout = logger.terminal
+    logger.close()
 
 
 # 弃用